@@ -0,0 +1,89 @@
+"""
+Benchmarks getting the booked blocks from the Lodgify availability calendar, with the response parsed all at once, and
+streamed (LODGIFY_CONFIGURATION's "stream_availability", which needs ijson installed).  Reports wall time and peak
+Python memory for each.  The fake API runs in its own process, so only the client's memory is counted.
+
+Run from the repo root, ex:
+
+    python benchmarks/bench_availability.py --filtered-entries 200000
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fakes import FakeApis
+from bench_lambda import install_config
+
+
+def serve(options, urls, stop):
+    """
+    Runs the fake API until told to stop, in a child process
+    """
+    fakes = FakeApis(latency=0, **options)
+    urls.put(fakes.start())
+    stop.wait()
+    fakes.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--units", type=int, default=20)
+    parser.add_argument("--bookings-per-unit", type=int, default=10)
+    parser.add_argument("--filtered-entries", type=int, default=100000,
+                        help="availability entries for available days and untracked properties")
+    parser.add_argument("--runs", type=int, default=3, help="runs of each mode, the fastest is reported")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    options = {"units": args.units, "bookings_per_unit": args.bookings_per_unit,
+               "filtered_entries": args.filtered_entries}
+    urls = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(options, urls, stop))
+    server.start()
+    base_url = urls.get()
+
+    try:
+        config = install_config(FakeApis(**options), base_url)
+        from lodgify import Lodgify
+        Lodgify.api_host = base_url + "lodgify/"
+
+        start_date = datetime.now().strftime("%m-%d-%Y")
+        end_date = (datetime.now() + timedelta(days=45)).strftime("%m-%d-%Y")
+
+        for stream in (False, True):
+            config.LODGIFY_CONFIGURATION['stream_availability'] = stream
+            # Time without tracemalloc, which slows down allocation heavy parsing, then measure memory on its own
+            best_wall = None
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                blocks = Lodgify().get_booking_blocks(start_date=start_date, end_date=end_date)
+                wall = time.perf_counter() - started
+                if not isinstance(blocks, list):
+                    raise RuntimeError(blocks)
+                best_wall = wall if best_wall is None else min(best_wall, wall)
+
+            tracemalloc.start()
+            Lodgify().get_booking_blocks(start_date=start_date, end_date=end_date)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print("{:<10} {} booked blocks of {} entries: {:.3f}s, peak memory {:.2f} MB".format(
+                "streamed" if stream else "buffered", len(blocks), len(blocks) + args.filtered_entries, best_wall,
+                peak / 1024 / 1024))
+    finally:
+        stop.set()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
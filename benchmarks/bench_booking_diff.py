@@ -0,0 +1,142 @@
+"""
+Benchmarks the cleaning automation's booking diff (booking_diff.diff_bookings) against the original nested loop
+version of CleaningNotifier._compare_bookings, on synthetic portfolios of 10 to 10,000 bookings.  It also checks that
+both give the same states for every booking.
+
+Run from the repo root: python benchmarks/bench_booking_diff.py
+"""
+
+import copy
+import logging
+import os
+import random
+import sys
+import timeit
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_code"))
+
+from booking_diff import diff_bookings
+
+PORTFOLIO_SIZES = [10, 100, 1000, 10000]
+BOOKINGS_PER_UNIT = 10
+TODAY = "2022-05-01"
+
+
+def legacy_compare(previous_bookings, consolidated_bookings):
+    """
+    The original CleaningNotifier._compare_bookings, with self replaced by arguments
+    """
+    bookings_have_changed = False
+    for unit, bookings in previous_bookings.items():
+
+        if unit not in consolidated_bookings:
+            consolidated_bookings[unit] = {}
+
+        logging.info(f"{unit}")
+        for booking, details in bookings.items():
+            logging.info(f"- Checking booking: {booking}")
+
+            if booking not in consolidated_bookings[unit]:
+                if details['check_out_date'] == TODAY:
+                    logging.info(f"-- checked out today, skipping")
+                    continue
+
+                logging.info(f"-- cancelled (not in list of current bookings)")
+                consolidated_bookings[unit][booking] = details
+                consolidated_bookings[unit][booking]['state'] = "Cancelled"
+                bookings_have_changed = True
+            else:
+                if consolidated_bookings[unit][booking] != details:
+                    logging.info(f"-- changed (details don't match current bookings:")
+                    for key, value in details.items():
+                        logging.info(f"---- {key}: {value} (old) / {consolidated_bookings[unit][booking][key]} (new)")
+                    consolidated_bookings[unit][booking]['state'] = "Changed"
+                    bookings_have_changed = True
+                else:
+                    logging.info(f"-- current (all details match)")
+                    consolidated_bookings[unit][booking]['state'] = "Current"
+
+    for unit, bookings in consolidated_bookings.items():
+        logging.info(f"{unit}")
+        for booking in bookings:
+            logging.info(f"- Checking booking: {booking}")
+            if booking not in previous_bookings.get(unit, {}):
+                logging.info(f"-- New (not in old bookings list)")
+                consolidated_bookings[unit][booking]['state'] = "New"
+                bookings_have_changed = True
+            else:
+                logging.info(f"-- Current (in both lists)")
+
+    return bookings_have_changed
+
+
+def make_portfolio(size, seed=0):
+    """
+    Builds a previous and current booking state, with about 5% of bookings each new, changed and cancelled
+    :param size: Number of bookings in the previous state
+    :return: (previous, current)
+    """
+    rng = random.Random(seed)
+    start = date(2022, 5, 1)
+    previous = {}
+    for index in range(size):
+        unit = f"Unit {index // BOOKINGS_PER_UNIT}"
+        check_in = start + timedelta(days=(index % BOOKINGS_PER_UNIT) * 4)
+        previous.setdefault(unit, {})[str(100000 + index)] = {
+            "check_in_date": check_in.isoformat(),
+            "check_out_date": (check_in + timedelta(days=3)).isoformat(),
+            "name": f"Guest {index}",
+            "status": "Booked"
+        }
+
+    current = copy.deepcopy(previous)
+    for unit, bookings in current.items():
+        for booking_id in list(bookings):
+            roll = rng.random()
+            if roll < 0.05:
+                del bookings[booking_id]
+            elif roll < 0.10:
+                bookings[booking_id]['check_out_date'] = "2022-08-01"
+        if rng.random() < 0.5:
+            bookings[str(900000 + len(bookings) + int(unit.split()[1]) * 100)] = {
+                "check_in_date": "2022-07-01",
+                "check_out_date": "2022-07-03",
+                "name": "New Guest",
+                "status": "Booked"
+            }
+    return previous, current
+
+
+def check_same_states(previous, current):
+    consolidated = copy.deepcopy(current)
+    legacy_changed = legacy_compare(copy.deepcopy(previous), consolidated)
+    diff = diff_bookings(previous, current, TODAY)
+
+    legacy_states = {(unit, booking_id): details['state']
+                     for unit, bookings in consolidated.items() for booking_id, details in bookings.items()}
+    new_states = {(unit, entry.booking_id): entry.state for unit, entries in diff.units.items() for entry in entries}
+    assert legacy_states == new_states, "diff engine states don't match the original compare"
+    assert legacy_changed == diff.has_changes
+
+
+def main():
+    # Both versions log at INFO, which is the dominant cost in Lambda.  Time them with it on, but not printed.
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+
+    print(f"{'bookings':>10} {'original (ms)':>15} {'diff engine (ms)':>18} {'speedup':>9}")
+    for size in PORTFOLIO_SIZES:
+        previous, current = make_portfolio(size)
+        check_same_states(previous, current)
+
+        runs = max(3, 20000 // size)
+        legacy = timeit.timeit(lambda: legacy_compare(copy.deepcopy(previous), copy.deepcopy(current)), number=runs)
+        copy_cost = timeit.timeit(lambda: (copy.deepcopy(previous), copy.deepcopy(current)), number=runs)
+        legacy = (legacy - copy_cost) / runs * 1000
+        engine = timeit.timeit(lambda: diff_bookings(previous, current, TODAY), number=runs) / runs * 1000
+
+        print(f"{size:>10} {legacy:>15.3f} {engine:>18.3f} {legacy / engine:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
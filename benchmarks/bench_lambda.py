@@ -0,0 +1,158 @@
+"""
+Benchmarks a full run of both lambdas (guest_handler.lambda_handler, then cleaning_handler.lambda_handler, as they are
+scheduled), either one on its own, or the fan-out mode (fanout_handler.py, with an in-process queue), against the local
+fakes in fakes.py for Lodgify, RemoteLock and Slack, and moto for SES and S3.  Reports wall time, HTTP calls per
+booking, response bytes, and peak Python memory.  With --etags the fakes answer conditional requests, so runs after
+the first show what the HTTP cache (http_cache.py) saves.
+
+Needs moto installed.  Run from the repo root, ex:
+
+    python benchmarks/bench_lambda.py --units 20 --bookings-per-unit 10 --latency 0.05 --error-rate 0.02
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_CODE = os.path.join(HERE, "..", "lambda_code")
+sys.path.insert(0, HERE)
+sys.path.insert(0, LAMBDA_CODE)
+
+from fakes import FakeApis
+
+BUCKET = "benchmark-bucket"
+FROM_ADDRESS = "automation@example.com"
+
+
+def install_config(fakes, base_url):
+    """
+    Loads config_template.py as the config module, pointed at the fakes
+    """
+    spec = importlib.util.spec_from_file_location("config", os.path.join(LAMBDA_CODE, "config_template.py"))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+
+    config.LISTING_MAPPING.clear()
+    config.LISTING_MAPPING.update(fakes.listing_mapping())
+    config.EMAIL_CONFIGURATION.update(error_reporting_destination=FROM_ADDRESS, from_address=FROM_ADDRESS)
+    config.CLEANING_EMAIL_DESTINATIONS[:] = [FROM_ADDRESS]
+    config.CLEANING_BUCKET_NAME = BUCKET
+    config.HTTP_CONFIGURATION['pool_sizes'] = {base_url: config.LODGIFY_CONFIGURATION['max_concurrent_requests']}
+    config.RETRY_CONFIGURATION['base_delay'] = 0.01
+    config.RETRY_CONFIGURATION['rate_limits'] = {}
+    config.HTTP_CONFIGURATION['cache']['directory'] = tempfile.mkdtemp(prefix="bench_http_cache_")
+    sys.modules["config"] = config
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=["full", "locks", "cleaning", "fanout"], default="full")
+    parser.add_argument("--units", type=int, default=10)
+    parser.add_argument("--bookings-per-unit", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per fake API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of GETs that get a 503")
+    parser.add_argument("--messages-per-booking", type=int, default=10)
+    parser.add_argument("--etags", action="store_true", help="fakes send ETags and answer If-None-Match with a 304")
+    parser.add_argument("--no-http-cache", action="store_true", help="turn off the HTTP cache")
+    parser.add_argument("--runs", type=int, default=1, help="runs in a row, later runs see the state saved by earlier ones")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows the run down")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    fakes = FakeApis(units=args.units, bookings_per_unit=args.bookings_per_unit, latency=args.latency,
+                     error_rate=args.error_rate, messages_per_booking=args.messages_per_booking, etags=args.etags)
+    base_url = fakes.start()
+    os.environ["SLACK_WEBHOOK"] = base_url + "slack"
+    config = install_config(fakes, base_url)
+    config.HTTP_CONFIGURATION['cache']['enabled'] = not args.no_http_cache
+
+    from moto import mock_aws
+    import aws_clients
+    from lodgify import Lodgify
+    from lock import Lock
+
+    Lodgify.api_host = base_url + "lodgify/"
+    Lock.host = base_url + "remotelock/connect/"
+    Lock.api_host = base_url + "remotelock/api/"
+
+    results = []
+    with mock_aws():
+        aws_clients.reset()
+        aws_clients.get_client("s3").create_bucket(Bucket=BUCKET)
+        aws_clients.get_client("ses").verify_email_identity(EmailAddress=FROM_ADDRESS)
+
+        import guest_handler
+        import cleaning_handler
+        import fanout_handler
+        from work_queue import LocalQueue
+
+        # The handlers turn on INFO logging when they are imported
+        logging.getLogger().setLevel(logging.WARNING)
+
+        # Keep the CloudWatch metric lines out of the benchmark report
+        from metrics import METRICS
+        METRICS.emit_emf = lambda run_name: None
+
+        for run in range(args.runs):
+            fakes.counts.clear()
+            fakes.bytes_sent = 0
+            if not args.no_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+
+            if args.scenario in ("full", "locks"):
+                guest_handler.lambda_handler({}, None)
+            if args.scenario in ("full", "cleaning"):
+                cleaning_handler.lambda_handler({}, None)
+            if args.scenario == "fanout":
+                queue = LocalQueue()
+                fanout_handler.coordinator_handler({}, None, queue=queue)
+                queue.drain(fanout_handler.worker_handler)
+
+            wall = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if not args.no_memory else None
+            if not args.no_memory:
+                tracemalloc.stop()
+
+            calls = sum(fakes.counts.values())
+            results.append({
+                "run": run + 1,
+                "scenario": args.scenario,
+                "bookings": len(fakes.bookings),
+                "wall_seconds": round(wall, 3),
+                "http_calls": calls,
+                "http_calls_per_booking": round(calls / len(fakes.bookings), 2),
+                "response_kb": round(fakes.bytes_sent / 1024, 1),
+                "peak_memory_mb": round(peak / 1024 / 1024, 2) if peak is not None else None,
+                "calls_by_route": dict(sorted(fakes.counts.items()))
+            })
+
+    fakes.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print(f"Run {result['run']} ({result['scenario']}, {result['bookings']} bookings): "
+              f"{result['wall_seconds']}s, {result['http_calls']} HTTP calls "
+              f"({result['http_calls_per_booking']} per booking), {result['response_kb']}KB of responses, peak memory {result['peak_memory_mb']} MB")
+        for route, count in result['calls_by_route'].items():
+            print(f"    {count:>6}  {route}")
+
+
+if __name__ == "__main__":
+    main()
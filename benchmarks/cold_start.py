@@ -0,0 +1,83 @@
+"""
+Checks the lambda's cold start: imports guest_handler in a fresh interpreter with python -X importtime, reports how
+long the import took, and fails if it is over budget, or if any of the heavy modules that should only be imported when
+they are first used (boto3, requests, the cleaning automation) are loaded at import time.
+
+Run from the repo root, ex:
+
+    python benchmarks/cold_start.py --budget-ms 60
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_CODE = os.path.abspath(os.path.join(HERE, "..", "lambda_code"))
+
+HANDLER = "guest_handler"
+LAZY_MODULES = ["boto3", "botocore", "requests", "asyncio", "cleaning_automation"]
+
+
+def measure_import(module, config_dir):
+    """
+    Imports the module in a fresh interpreter, and parses the -X importtime report
+    :param module: name of the module to import
+    :param config_dir: directory holding the config.py to import it with
+    :return: dict of the top level package of each imported module, to its cumulative import time in microseconds
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([config_dir, LAMBDA_CODE]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)], env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, result.stderr))
+
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imported[name.strip()] = int(cumulative)
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=60, help="most the handler's import may take")
+    parser.add_argument("--runs", type=int, default=5, help="imports to time, the fastest is reported")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    config_dir = tempfile.mkdtemp()
+    shutil.copy(os.path.join(LAMBDA_CODE, "config_template.py"), os.path.join(config_dir, "config.py"))
+    try:
+        runs = [measure_import(HANDLER, config_dir) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(config_dir)
+
+    import_ms = min(run[HANDLER] for run in runs) / 1000
+    eager = [module for module in LAZY_MODULES if module in runs[0]]
+    result = {
+        "module": HANDLER,
+        "import_ms": round(import_ms, 1),
+        "budget_ms": args.budget_ms,
+        "eager_imports": eager,
+        "ok": import_ms <= args.budget_ms and not eager
+    }
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("{} imports in {:.1f} ms (budget {} ms)".format(HANDLER, import_ms, args.budget_ms))
+        if eager:
+            print("Imported at cold start, but should be lazy: {}".format(", ".join(eager)))
+
+    sys.exit(0 if result["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Local stand-ins for the Lodgify, RemoteLock and Slack APIs, for benchmarking.  One threaded HTTP server on localhost
+serves all of them under different path prefixes, with a configurable portfolio size, per-request latency and error
+rate.  Requests are counted per route.
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIRST_PROPERTY_ID = 500000
+FIRST_BOOKING_ID = 1000000
+CODE_MARKER = "The code to open the lock for your upcoming rental is"
+
+
+class FakeApis:
+
+    def __init__(self, units=10, bookings_per_unit=10, latency=0.02, error_rate=0.0, messages_per_booking=10,
+                 seed=0, filtered_entries=0, etags=False):
+        """
+        :param units: Number of rental units (every other one has a remote lock)
+        :param bookings_per_unit: Number of bookings per unit, spread across the next 45 days
+        :param latency: Seconds each request takes to answer
+        :param error_rate: Fraction of GET requests that get a 503 (with Retry-After: 0)
+        :param messages_per_booking: Size of each booking's message history
+        :param seed: Seed for the error injection
+        :param filtered_entries: Extra availability entries, for available days and untracked properties, that the
+            Lodgify client filters out
+        :param etags: Send an ETag with GET responses, and answer a matching If-None-Match with a 304
+        """
+        self.units = units
+        self.bookings_per_unit = bookings_per_unit
+        self.latency = latency
+        self.error_rate = error_rate
+        self.messages_per_booking = messages_per_booking
+        self.filtered_entries = filtered_entries
+        self.etags = etags
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+        self.bookings = {}
+        today = date.today()
+        for unit in range(units):
+            for index in range(bookings_per_unit):
+                booking_id = FIRST_BOOKING_ID + unit * bookings_per_unit + index
+                arrival = today + timedelta(days=index * 45 // bookings_per_unit)
+                self.bookings[booking_id] = {
+                    "property_id": FIRST_PROPERTY_ID + unit,
+                    "arrival": arrival,
+                    "departure": arrival + timedelta(days=max(1, 45 // bookings_per_unit - 1)),
+                    "code_sent": booking_id % 3 == 0
+                }
+        self.access_persons = [{"id": f"existing-{index}", "attributes": {"name": f"Guest {index}", "pin": str(20000 + index)}}
+                               for index in range(units * bookings_per_unit)]
+
+
+    def listing_mapping(self):
+        """
+        :return: LISTING_MAPPING for the fake portfolio
+        """
+        return {FIRST_PROPERTY_ID + unit: {
+                    "display_name": f"Unit {unit}",
+                    "lock_device_id": f"device-{unit}" if unit % 2 == 0 else ""
+                } for unit in range(self.units)}
+
+
+    def start(self):
+        """
+        Starts the server on a free local port
+        :return: base URL, ex: "http://127.0.0.1:54321/"
+        """
+        fakes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fakes.handle(self, "GET")
+
+            def do_POST(self):
+                fakes.handle(self, "POST")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def count(self, route):
+        with self._lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        query = parse_qs(url.query)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        route = method + " " + re.sub(r"/\d+", "/{id}", re.sub(r"/access_persons/[^/]+/", "/access_persons/{id}/", url.path))
+        self.count(route)
+
+        time.sleep(self.latency)
+        with self._lock:
+            fail = method == "GET" and self.random.random() < self.error_rate
+        if fail:
+            return self.respond(request, 503, {"error": "injected"}, headers={"Retry-After": "0"})
+
+        status, payload = self.route(method, url.path, query, body)
+        self.respond(request, status, payload, etag=self.etags and method == "GET" and status == 200)
+
+
+    def respond(self, request, status, payload, headers=None, etag=False):
+        body = json.dumps(payload).encode("utf-8")
+        headers = dict(headers or {})
+        if etag:
+            headers["ETag"] = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                status, body = 304, b""
+        with self._lock:
+            self.bytes_sent += len(body)
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+
+    def route(self, method, path, query, body):
+        match = re.fullmatch(r"/lodgify/v1/reservation/booking/(\d+)", path)
+        if method == "GET" and match:
+            return self.booking_v1(int(match.group(1)))
+
+        if method == "GET" and path == "/lodgify/v2/reservations/bookings":
+            return self.bookings_v2(query)
+
+        match = re.fullmatch(r"/lodgify/v2/reservations/bookings/(\d+)", path)
+        if method == "GET" and match:
+            return 200, {"id": int(match.group(1)), "thread_uid": f"thread-{match.group(1)}"}
+
+        if method == "GET" and path == "/lodgify/v1/availability":
+            return self.availability(query)
+
+        if method == "POST" and path == "/remotelock/connect/oauth/token":
+            return 200, {"access_token": "fake-token", "expires_in": 7200}
+
+        if method == "GET" and path == "/remotelock/api/access_persons":
+            page = int(query.get("page", ["1"])[0])
+            per_page = int(query.get("per_page", ["25"])[0])
+            total_pages = max(1, -(-len(self.access_persons) // per_page))
+            return 200, {"data": self.access_persons[(page - 1) * per_page:page * per_page],
+                         "meta": {"page": page, "per_page": per_page, "total_pages": total_pages}}
+
+        if method == "POST" and path == "/remotelock/api/access_persons":
+            attributes = json.loads(body)['attributes']
+            guest = {"id": f"guest-{len(self.access_persons)}", "attributes": attributes}
+            with self._lock:
+                self.access_persons.append(guest)
+            return 201, {"data": guest}
+
+        if method == "POST" and re.fullmatch(r"/remotelock/api/access_persons/[^/]+/accesses", path):
+            return 201, {"data": {"id": "access"}}
+
+        if method == "POST" and path == "/slack":
+            return 200, {"ok": True}
+
+        return 404, {"error": f"no fake for {method} {path}"}
+
+
+    def availability(self, query):
+        start = datetime.strptime(query['periodStart'][0], "%m-%d-%Y").date()
+        end = datetime.strptime(query['periodEnd'][0], "%m-%d-%Y").date()
+        entries = []
+        for booking_id, booking in self.bookings.items():
+            if booking['arrival'] > end or booking['departure'] < start:
+                continue
+            entries.append({
+                "is_available": False,
+                "booking_ids": [booking_id],
+                "property_id": booking['property_id'],
+                "period_start": f"{booking['arrival'].isoformat()}T00:00:00",
+                "period_end": f"{booking['departure'].isoformat()}T00:00:00"
+            })
+        for index in range(self.filtered_entries):
+            entries.append({
+                "is_available": index % 2 == 0,
+                "booking_ids": [] if index % 2 == 0 else [FIRST_BOOKING_ID + len(self.bookings) + index],
+                "property_id": FIRST_PROPERTY_ID + self.units + index % 50,
+                "period_start": f"{start.isoformat()}T00:00:00",
+                "period_end": f"{end.isoformat()}T00:00:00"
+            })
+        return 200, entries
+
+
+    def bookings_v2(self, query):
+        start = datetime.strptime(query['stayFilterDate'][0][:10], "%Y-%m-%d").date()
+        page = int(query.get("page", ["1"])[0])
+        size = int(query.get("size", ["50"])[0])
+        items = [{
+            "id": booking_id,
+            "property_id": booking['property_id'],
+            "status": "Booked",
+            "arrival": booking['arrival'].isoformat(),
+            "departure": booking['departure'].isoformat(),
+            "guest": {"id": f"guest-{booking_id}", "name": f"Guest {booking_id}", "email": f"guest{booking_id}@example.com"},
+            "updated_at": "2022-04-25T12:49:48",
+            "thread_uid": f"thread-{booking_id}",
+            "is_deleted": False
+        } for booking_id, booking in sorted(self.bookings.items()) if booking['departure'] >= start]
+        return 200, {"count": len(items), "items": items[(page - 1) * size:page * size]}
+
+
+    def booking_v1(self, booking_id):
+        booking = self.bookings.get(booking_id)
+        if booking is None:
+            return 404, {"error": "no such booking"}
+
+        messages = [{"subject": "Question", "message": "Lorem ipsum dolor sit amet. " * 20, "type": "Renter",
+                     "is_replied": True, "created_at": "2022-05-26T14:04:51"} for _ in range(self.messages_per_booking)]
+        if booking['code_sent']:
+            messages.append({"subject": "Door code", "message": f"\n{CODE_MARKER}: 12345.", "type": "Owner",
+                             "is_replied": True, "created_at": "2022-05-26T14:04:51"})
+
+        return 200, {
+            "id": booking_id,
+            "type": "Booking",
+            "status": "Booked",
+            "guest": {"id": f"guest-{booking_id}", "name": f"Guest {booking_id}", "email": f"guest{booking_id}@example.com"},
+            "arrival": booking['arrival'].isoformat(),
+            "departure": booking['departure'].isoformat(),
+            "people": 2,
+            "property_id": booking['property_id'],
+            "rooms": [{"name": "Room", "room_type_id": 1, "people": 2, "key_code": None}],
+            "created_at": "2022-04-25T12:49:48",
+            "updated_at": "2022-04-25T12:49:48",
+            "currency": {"id": 50, "code": "USD", "name": "US dollar", "euro_forex": 1.0577, "symbol": "$"},
+            "messages": messages
+        }
@@ -0,0 +1,86 @@
+"""
+Registry of boto3 clients.  Each is created on first use and kept at module level, so it is reused across calls and
+across warm Lambda invocations instead of being rebuilt (and botocore's data reloaded) every time.
+
+boto3 itself is only imported when the first client is needed, to keep it out of the Lambda's cold start.  Every call
+made through these clients is recorded in the run's metrics.  Tests can swap in a stand-in with set_client, or call
+reset() to have the next call build a real client again (e.g. inside a moto mock).
+"""
+
+import threading
+import time
+from config import AWS_CONFIGURATION
+from metrics import METRICS
+
+_clients = {}
+
+# boto3's default session is not safe to build clients from on several threads at once
+_lock = threading.Lock()
+
+
+def _body_size(body):
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        position = body.tell()
+        size = body.seek(0, 2)
+        body.seek(position)
+        return size
+    return 0
+
+
+def _start_timer(params, context, **kwargs):
+    context['metrics_bytes_sent'] = _body_size(params.get('body'))
+    context['metrics_started'] = time.perf_counter()
+
+
+def _record_call(http_response, parsed, model, context, **kwargs):
+    started = context.get('metrics_started')
+    if started is None:
+        return
+    METRICS.record(api=model.service_model.service_id,
+                   endpoint=model.name,
+                   latency=time.perf_counter() - started,
+                   bytes_sent=context.get('metrics_bytes_sent', 0),
+                   bytes_received=int(http_response.headers.get('Content-Length') or 0),
+                   retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+
+def _instrument(client):
+    """
+    Hooks a client's botocore events, so each of its calls is timed and recorded
+    """
+    client.meta.events.register('before-call', _start_timer)
+    client.meta.events.register('after-call', _record_call)
+    return client
+
+
+def get_client(service):
+    """
+    Gets the shared client for an AWS service, in the configured region
+    :param service: Service name, ex: "ses"
+    :return: boto3 client
+    """
+    with _lock:
+        if service not in _clients:
+            import boto3
+            _clients[service] = _instrument(boto3.client(service, region_name=AWS_CONFIGURATION['region']))
+        return _clients[service]
+
+
+def set_client(service, client):
+    """
+    Replaces the shared client for a service, ex: with a local stand-in for tests
+    :param service: Service name, ex: "ses"
+    :param client: Object to hand out from get_client
+    """
+    with _lock:
+        _clients[service] = client
+
+
+def reset():
+    """
+    Drops all shared clients, so the next call creates new ones
+    """
+    with _lock:
+        _clients.clear()
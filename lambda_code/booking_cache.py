@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+import time
+import aws_clients
+from booking_record import BookingRecord
+from config import CLEANING_BUCKET_NAME, SHARED_BOOKING_CACHE_MAX_AGE_MINUTES
+
+BOOKING_CACHE_KEY = 'booking_cache.json'
+
+
+class BookingCache:
+    """
+    Cache of Lodgify booking details, keyed by booking ID.  The lock automation saves what it fetched to S3 at the end
+    of its run, and the cleaning report, which runs as a separate lambda, loads any entries that are still fresh, so a
+    booking fetched by one flow is not fetched again by the other.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+
+    def get(self, booking_id):
+        """
+        Gets the cached details for a booking
+        :param booking_id: The booking to look up
+        :return: BookingRecord, or None if the booking has not been fetched this run
+        """
+        with self._lock:
+            entry = self.entries.get(str(booking_id))
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry['details']
+
+
+    def put(self, booking_id, details):
+        """
+        Stores the details for a booking, along with the Lodgify updated_at stamp
+        :param booking_id: The booking the details belong to
+        :param details: BookingRecord
+        """
+        with self._lock:
+            self.entries[str(booking_id)] = {
+                "updated_at": details.updated_at,
+                "cached_at": time.time(),
+                "details": details
+            }
+
+
+    def updated_at(self, booking_id):
+        """
+        Gets the Lodgify updated_at stamp for a cached booking
+        :param booking_id: The booking to look up
+        :return: updated_at string, or None if the booking is not cached
+        """
+        entry = self.entries.get(str(booking_id))
+        if entry is None:
+            return None
+        return entry['updated_at']
+
+
+    def load(self):
+        """
+        Loads the entries saved to S3 by the last run of the lock automation, dropping any older than the configured
+        max age.  A missing file just means an empty cache.
+        """
+        s3 = aws_clients.get_client('s3')
+        try:
+            response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=BOOKING_CACHE_KEY)
+        except s3.exceptions.NoSuchKey:
+            logging.info(f"No {BOOKING_CACHE_KEY} found, starting with an empty booking cache")
+            return
+
+        oldest = time.time() - SHARED_BOOKING_CACHE_MAX_AGE_MINUTES * 60
+        saved = json.loads(response['Body'].read().decode('utf-8'))
+        with self._lock:
+            for booking_id, entry in saved.items():
+                if entry['cached_at'] < oldest:
+                    continue
+                try:
+                    entry['details'] = BookingRecord.from_dict(entry['details'])
+                except TypeError:
+                    # Saved as a raw Lodgify payload, before bookings were cached as records
+                    continue
+                self.entries[booking_id] = entry
+
+        logging.info(f"Loaded {len(self.entries)} of {len(saved)} saved bookings into the booking cache")
+
+
+    def save(self):
+        """
+        Saves the entries to S3, for the other lambda to use
+        """
+        with self._lock:
+            body = json.dumps({booking_id: dict(entry, details=entry['details'].to_dict())
+                               for booking_id, entry in self.entries.items()})
+
+        s3 = aws_clients.get_client('s3')
+        s3.put_object(
+            Body=body,
+            Bucket=CLEANING_BUCKET_NAME,
+            Key=BOOKING_CACHE_KEY
+        )
+
+
+    def log_stats(self):
+        logging.info(f"Booking cache: {len(self.entries)} bookings, {self.hits} hits, {self.misses} misses")
+
+
+    def __contains__(self, booking_id):
+        return str(booking_id) in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,89 @@
+"""
+Diff engine for the cleaning automation.  Compares the bookings saved by the last run to the current bookings, unit by
+unit, using set operations on the booking IDs and comparing the details of bookings in both, and returns an immutable
+BookingDiff for the email and Slack formatters to read.
+"""
+
+import logging
+from collections import namedtuple
+from types import MappingProxyType
+
+# States that count as an update worth emailing about
+CHANGE_STATES = ("New", "Changed", "Cancelled")
+
+# One booking in the diff: its ID, a read-only view of its details, and its state (New, Changed, Cancelled, Current)
+DiffEntry = namedtuple("DiffEntry", ["booking_id", "details", "state"])
+
+
+class BookingDiff(namedtuple("BookingDiff", ["units", "new", "changed", "cancelled", "current"])):
+    """
+    Result of comparing two booking states.
+
+    units maps each unit to a tuple of DiffEntry, with current bookings first (in the order Lodgify returned them) and
+    cancelled bookings after.  new, changed, cancelled and current are frozensets of (unit, booking ID).
+    """
+    __slots__ = ()
+
+    @property
+    def has_changes(self):
+        return bool(self.new or self.changed or self.cancelled)
+
+
+    def to_state(self):
+        """
+        Builds the state to save for the next run: every current booking, without the cancelled ones
+        :return: dict of unit -> booking ID -> details
+        """
+        return {unit: {entry.booking_id: dict(entry.details) for entry in entries if entry.state != "Cancelled"}
+                for unit, entries in self.units.items()}
+
+
+def diff_bookings(previous, current, today):
+    """
+    Compares the previous run's bookings to the current ones
+    :param previous: dict of unit -> booking ID -> details, from the last run
+    :param current: dict of unit -> booking ID -> details, from Lodgify now
+    :param today: Today's date (format: YYYY-MM-DD).  Previous bookings that check out today are dropped, rather than
+        being reported as cancelled.
+    :return: BookingDiff
+    """
+    units = {}
+    new, changed, cancelled, current_ids = set(), set(), set(), set()
+
+    # Units with current bookings come first, then units that only had bookings last run
+    for unit in list(current) + [unit for unit in previous if unit not in current]:
+        current_bookings = current.get(unit, {})
+        previous_bookings = previous.get(unit, {})
+
+        new_ids = current_bookings.keys() - previous_bookings.keys()
+        cancelled_ids = previous_bookings.keys() - current_bookings.keys()
+        changed_ids = {booking_id for booking_id in current_bookings.keys() & previous_bookings.keys()
+                       if current_bookings[booking_id] != previous_bookings[booking_id]}
+
+        entries = []
+        for booking_id, details in current_bookings.items():
+            if booking_id in new_ids:
+                state = "New"
+                new.add((unit, booking_id))
+            elif booking_id in changed_ids:
+                state = "Changed"
+                changed.add((unit, booking_id))
+                logging.info(f"{unit} booking {booking_id} changed: {previous_bookings[booking_id]} (old) / {details} (new)")
+            else:
+                state = "Current"
+                current_ids.add((unit, booking_id))
+            entries.append(DiffEntry(booking_id, MappingProxyType(dict(details)), state))
+
+        for booking_id, details in previous_bookings.items():
+            if booking_id not in cancelled_ids:
+                continue
+            if details['check_out_date'] == today:
+                continue
+            cancelled.add((unit, booking_id))
+            entries.append(DiffEntry(booking_id, MappingProxyType(dict(details)), "Cancelled"))
+
+        units[unit] = tuple(entries)
+
+    logging.info(f"Booking diff: {len(new)} new, {len(changed)} changed, {len(cancelled)} cancelled, {len(current_ids)} current")
+    return BookingDiff(units=MappingProxyType(units), new=frozenset(new), changed=frozenset(changed),
+                       cancelled=frozenset(cancelled), current=frozenset(current_ids))
@@ -0,0 +1,121 @@
+"""
+Compact record of a Lodgify booking.  Lodgify's booking payloads carry the whole message history, the rooms, the
+currency and payment details, and more, but the automations only use a handful of fields.  A BookingRecord keeps just
+those, parsed once, with the unit's display name and lock device looked up in LISTING_MAPPING at the same time, and the
+message history reduced to whether a door code has already been sent.  The raw payload isn't kept.
+
+Records are what Lodgify.get_booking_details and Lodgify.get_bookings_sweep return, what the booking cache holds, and
+what the cleaning state is built from.
+"""
+
+from config import CODE_EMAIL_TEMPLATE, LISTING_MAPPING
+
+# Part of the door code message, to spot one that has already been sent in a booking's messages
+CODE_SENT_MARKER = CODE_EMAIL_TEMPLATE[3:25]
+
+
+class BookingRecord:
+    """
+    The fields of a booking the automations use.  unit and lock_device_id are None for properties that are not in
+    LISTING_MAPPING, and code_sent is None when the booking's messages were not part of the payload.
+    """
+    __slots__ = ("booking_id", "property_id", "unit", "lock_device_id", "status", "arrival", "departure", "guest_name",
+                 "guest_email", "updated_at", "thread_uid", "code_sent", "is_deleted")
+
+    # Fields saved by to_dict, the rest are looked up again when a record is loaded
+    FIELDS = ("booking_id", "property_id", "status", "arrival", "departure", "guest_name", "guest_email", "updated_at",
+              "thread_uid", "code_sent", "is_deleted")
+
+    def __init__(self, booking_id, property_id, status, arrival, departure, guest_name, guest_email=None,
+                 updated_at=None, thread_uid=None, code_sent=None, is_deleted=False):
+        self.booking_id = booking_id
+        self.property_id = property_id
+        self.status = status
+        self.arrival = arrival
+        self.departure = departure
+        self.guest_name = guest_name
+        self.guest_email = guest_email
+        self.updated_at = updated_at
+        self.thread_uid = thread_uid
+        self.code_sent = code_sent
+        self.is_deleted = is_deleted
+
+        listing = LISTING_MAPPING.get(property_id)
+        self.unit = listing['display_name'] if listing else None
+        self.lock_device_id = (listing['lock_device_id'] or None) if listing else None
+
+
+    @classmethod
+    def from_v1(cls, details):
+        """
+        Parses a booking from the v1 booking details endpoint
+        :param details: dict, as returned by Lodgify (see Lodgify.get_booking_details)
+        :return: BookingRecord
+        """
+        code_sent = None
+        if details.get('messages') is not None:
+            code_sent = any(CODE_SENT_MARKER in (message.get('message') or "") for message in details['messages'])
+
+        return cls(booking_id=details['id'],
+                   property_id=details['property_id'],
+                   status=details['status'],
+                   arrival=details['arrival'],
+                   departure=details['departure'],
+                   guest_name=details['guest']['name'],
+                   guest_email=details['guest'].get('email'),
+                   updated_at=details.get('updated_at'),
+                   code_sent=code_sent,
+                   is_deleted=bool(details.get('is_deleted')))
+
+
+    @classmethod
+    def from_v2(cls, item):
+        """
+        Parses a booking from the v2 bookings list, which has no messages
+        :param item: dict, one of the items in a page of the v2 bookings list
+        :return: BookingRecord
+        """
+        return cls(booking_id=item['id'],
+                   property_id=item['property_id'],
+                   status=item['status'],
+                   arrival=item['arrival'][:10],
+                   departure=item['departure'][:10],
+                   guest_name=item['guest']['name'],
+                   guest_email=item['guest'].get('email'),
+                   updated_at=item.get('updated_at'),
+                   thread_uid=item.get('thread_uid'),
+                   is_deleted=bool(item.get('is_deleted')))
+
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Loads a record saved with to_dict
+        :param data: dict
+        :return: BookingRecord
+        """
+        return cls(**data)
+
+
+    def to_dict(self):
+        """
+        :return: dict of the record's fields, for saving as JSON
+        """
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+    def state_entry(self):
+        """
+        :return: dict of the booking's entry in the cleaning state, as diffed by booking_diff.py and saved by
+            state_store.py
+        """
+        return {
+            "check_in_date": self.arrival,
+            "check_out_date": self.departure,
+            "name": self.guest_name,
+            "status": self.status
+        }
+
+
+    def __repr__(self):
+        return f"BookingRecord({self.booking_id}, {self.unit}, {self.status}, {self.arrival} - {self.departure})"
@@ -0,0 +1,126 @@
+"""
+Incremental booking sync for the cleaning automation.  Rather than fetching full details for every booking in the
+window on every run, the updated_at stamp, a hash of the availability block, and the booking's BookingRecord are
+saved for each booking in a JSON file next to rentals.json in S3.  On the next run only bookings that are new, whose
+availability block has changed, that were not yet "Booked" (status can change without the dates changing), or whose
+saved details are older than INCREMENTAL_BOOKING_SYNC_MAX_AGE_HOURS are fetched from Lodgify.  Everything else is
+served from the saved details.  The max age bounds how long other edits, like a change to the guest's name, take to
+show up, as nothing in the availability block tells us about them.
+
+Cancelled bookings drop out of the availability response, so they are dropped from the sync state and still show up
+as cancelled when the cleaning automation compares against the previous run.
+"""
+
+import hashlib
+import json
+import logging
+import time
+import aws_clients
+from booking_record import BookingRecord
+from config import CLEANING_BUCKET_NAME, INCREMENTAL_BOOKING_SYNC_MAX_AGE_HOURS
+
+SYNC_STATE_KEY = 'booking_sync.json'
+
+
+def block_hash(block):
+    """
+    Hashes the parts of an availability block that tell us a booking has moved
+    :param block: A block, as returned by Lodgify.get_booking_blocks
+    :return: hex digest string
+    """
+    content = json.dumps([block['property_id'], block['period_start'], block['period_end']])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class BookingSync:
+
+    def __init__(self):
+        self.state = self._load_state()
+
+
+    def _load_state(self):
+        """
+        Loads the sync state from S3.  A missing file just means every booking is treated as new.
+        :return: dict of booking ID to {"updated_at": ..., "fetched_at": ..., "hash": ..., "details": {...}}
+        """
+        s3 = aws_clients.get_client('s3')
+        try:
+            response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=SYNC_STATE_KEY)
+        except s3.exceptions.NoSuchKey:
+            logging.info(f"No {SYNC_STATE_KEY} found, doing a full booking sync")
+            return {}
+
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+
+    def needs_refresh(self, block):
+        """
+        Checks if a booking must be fetched from Lodgify, or if the saved details are still good
+        :param block: A block, as returned by Lodgify.get_booking_blocks
+        :return: True or False
+        """
+        saved = self.state.get(str(block['booking_id']))
+        if saved is None:
+            return True
+        if saved['hash'] != block_hash(block):
+            return True
+        # Saved before bookings were stored as records
+        if 'booking_id' not in saved['details']:
+            return True
+        if saved['details']['status'] != "Booked":
+            return True
+        if time.time() - saved.get('fetched_at', 0) > INCREMENTAL_BOOKING_SYNC_MAX_AGE_HOURS * 3600:
+            return True
+        return False
+
+
+    def sync(self, lodgify_client, blocks):
+        """
+        Fetches details for new and changed bookings, and seeds the client's booking cache with the saved details for
+        the rest, so a following get_booking_details_many makes no calls for unchanged bookings
+        :param lodgify_client: Lodgify client whose booking cache should be seeded
+        :param blocks: List of blocks, as returned by Lodgify.get_booking_blocks
+        """
+        to_fetch = []
+        served = set()
+        for block in blocks:
+            booking_id = block['booking_id']
+            if booking_id in lodgify_client.booking_cache:
+                continue
+            if self.needs_refresh(block):
+                to_fetch.append(booking_id)
+            else:
+                lodgify_client.booking_cache.put(booking_id, BookingRecord.from_dict(self.state[str(booking_id)]['details']))
+                served.add(str(booking_id))
+
+        logging.info(f"Incremental sync: {len(to_fetch)} of {len(blocks)} bookings are new or changed")
+        lodgify_client.get_booking_details_many(booking_ids=to_fetch)
+
+        # Rebuild the state from the current window, which also drops cancelled bookings
+        new_state = {}
+        now = time.time()
+        for block in blocks:
+            details = lodgify_client.booking_cache.get(block['booking_id'])
+            if details is None:
+                continue
+            # Details served from the saved state keep their age, anything else was just fetched
+            booking_id = str(block['booking_id'])
+            new_state[booking_id] = {
+                "updated_at": details.updated_at,
+                "fetched_at": self.state[booking_id].get('fetched_at', 0) if booking_id in served else now,
+                "hash": block_hash(block),
+                "details": details.to_dict()
+            }
+        self.state = new_state
+
+
+    def save(self):
+        """
+        Saves the sync state to S3, for the next run
+        """
+        s3 = aws_clients.get_client('s3')
+        s3.put_object(
+            Body=json.dumps(self.state),
+            Bucket=CLEANING_BUCKET_NAME,
+            Key=SYNC_STATE_KEY
+        )
@@ -19,19 +19,27 @@ Unit 6
 ----------------------
 In: 2022-05-27, Out: 2022-05-29 (Changed!)
 
+Current bookings are listed by check-in, followed by cancelled ones.  Turnover cleans (a check-in on the day of another
+booking's check-out) and double bookings (bookings that overlap at the same unit) are flagged in the email and Slack
+message.
+
 It will also send a current copy of the cleaning schedule to Slack, with a note as to if there had been any changes, and
 if an email was actually sent or not.
 """
 
 from datetime import datetime, timedelta
-import boto3
+import aws_clients
 from lodgify import Lodgify
+from booking_sync import BookingSync
+from state_store import BookingStateStore
+from booking_diff import diff_bookings, CHANGE_STATES
+from stay_index import StayIndex
 import logging
-from config import CLEANING_EMAIL_DESTINATIONS, LISTING_MAPPING, \
-    AWS_CONFIGURATION, EMAIL_CONFIGURATION, DAYS_IN_FUTURE_FOR_CLEANINGS, CLEANING_BUCKET_NAME, \
-    EMAIL_LINE_COLOR_MAPPINGS
+from config import CLEANING_EMAIL_DESTINATIONS, \
+    EMAIL_CONFIGURATION, DAYS_IN_FUTURE_FOR_CLEANINGS, \
+    EMAIL_LINE_COLOR_MAPPINGS, INCREMENTAL_BOOKING_SYNC, LODGIFY_CONFIGURATION
 import json
-import requests
+import http_session
 import os
 
 
@@ -83,7 +91,7 @@ def send_cleaning_slack_output(body, sent):
         "blocks": message_blocks
     }
 
-    response = requests.post(os.getenv("SLACK_WEBHOOK"), headers=headers, json=message)
+    response = http_session.post(os.getenv("SLACK_WEBHOOK"), headers=headers, json=message)
 
 
 def send_email(message):
@@ -91,7 +99,7 @@ def send_email(message):
     Sends the cleaning update email
     :param message: HTML formatted message with the cleaning details
     """
-    client = boto3.client('ses', region_name=AWS_CONFIGURATION['region'])
+    client = aws_clients.get_client('ses')
     client.send_email(
         Source=EMAIL_CONFIGURATION['from_address'],
         Destination={
@@ -116,11 +124,114 @@ def send_email(message):
     )
 
 
+def unit_schedule(entries):
+    """
+    Orders a unit's entries for the report: current bookings by check-in, then cancelled bookings
+    :param entries: The unit's tuple of DiffEntry, from a BookingDiff
+    :return: tuple of the unit's StayIndex, and a list of (Stay, DiffEntry), where the Stay is None for cancelled
+        bookings
+    """
+    index = StayIndex.from_entries(entries)
+    by_id = {entry.booking_id: entry for entry in entries}
+    schedule = [(stay, by_id[stay.booking_id]) for stay in index.stays]
+    schedule += [(None, entry) for entry in entries if entry.state == "Cancelled"]
+    return index, schedule
+
+
+def format_slack_output(booking_diff):
+    """
+    Formats a block of markdown text to send a slack message update
+    :param booking_diff: BookingDiff to format
+    :return: markdown formatted message body
+    """
+    logging.info("")
+    logging.info("================")
+    logging.info("Formatting Slack Message")
+    logging.info("================")
+    logging.info("")
+
+    slack_output = "\n"
+    for unit, entries in booking_diff.units.items():
+        index, schedule = unit_schedule(entries)
+        double_booked = index.double_bookings()
+        slack_output += f"{unit}\n"
+        slack_output += "----------------------\n"
+
+        for stay, (booking, details, state) in schedule:
+
+            line = f"{details['name']} - In: {details['check_in_date'][5:]}, Out: {details['check_out_date'][5:]}"
+            if state in CHANGE_STATES:
+                line += f" ({state}!)"
+            if stay and index.is_turnover(stay):
+                line += " (Turnover)"
+            if booking in double_booked:
+                line += " (DOUBLE BOOKED!)"
+
+            line += "\n"
+            slack_output += line
+
+        slack_output += "\n"
+
+    logging.info(slack_output)
+    return slack_output
+
+
+def format_email_output(booking_diff):
+    """
+    Formats the cleaning update email, based on the booking comparison output
+    :param booking_diff: BookingDiff to format
+    :return: HTML formatted email message body
+    """
+
+    logging.info("")
+    logging.info("================")
+    logging.info("Formatting Cleaning Email")
+    logging.info("================")
+    logging.info("")
+
+    html_email_output = ""
+
+    for unit, entries in booking_diff.units.items():
+        index, schedule = unit_schedule(entries)
+        double_booked = index.double_bookings()
+        html_email_output += f"<b>{unit}</b><br>"
+        html_email_output += "----------------------<br>"
+        logging.info(f"{unit}")
+        logging.info("---------------")
+
+        for position, (stay, (booking, details, state)) in enumerate(schedule):
+
+            if position == 0:
+                line = ""
+            elif stay and index.is_turnover(stay):
+                line = "&nbsp;&nbsp;&nbsp;&nbsp;(*** IS A TURNOVER CLEAN ***)<br>"
+            else:
+                line = "<br>"
+
+            if state in CHANGE_STATES:
+                line += f"""<font style="color:{EMAIL_LINE_COLOR_MAPPINGS[state]}";><b>In:</b> {details['check_in_date'][5:]}, <b>Out:</b> {details['check_out_date'][5:]} ({state}!)</font>"""
+            else:
+                line += f"<b>In:</b> {details['check_in_date'][5:]}, <b>Out:</b> {details['check_out_date'][5:]}"
+
+            if booking in double_booked:
+                logging.warning(f"{unit} booking {booking} overlaps another booking: {dict(details)}")
+                line += f"""&nbsp;<font style="color:{EMAIL_LINE_COLOR_MAPPINGS.get('Double Booked', 'red')}";><b>(*** DOUBLE BOOKED ***)</b></font>"""
+
+            html_email_output += line
+
+        html_email_output += "<br><br>"
+        logging.info("")
+
+    return html_email_output
+
+
 class CleaningNotifier:
 
-    def __init__(self):
+    def __init__(self, lodgify_client=None):
 
-        self.lodgify_client = Lodgify()
+        # Reuse the caller's client when given, so bookings it already fetched come from its booking cache
+        self.lodgify_client = lodgify_client if lodgify_client is not None else Lodgify()
+        self.state_store = BookingStateStore()
         self.current_bookings = self._get_current_bookings()
         self.previous_bookings = self._get_previous_bookings()
         self.bookings_have_changed = False
@@ -128,42 +239,16 @@ class CleaningNotifier:
 
     def _save_updated_bookings(self):
         """
-        Removes the state from consolidated bookings, and removes any cancelled bookings.  Then it saves the JSON
-        to a file in the the S3 bucket configured in config.py
+        Saves the current bookings (without any cancelled ones) to the S3 bucket configured in config.py (see
+        state_store.py)
         """
-        # Delete any cancelled bookings
-        bookings_to_delete =[]
-        for unit, bookings in self.consolidated_bookings.items():
-            for booking, details in bookings.items():
-                if details['state'] == "Cancelled":
-                    logging.info(f"-- Removing cancelled booking {booking}")
-                    bookings_to_delete.append({
-                        "unit": unit,
-                        "id": booking
-                    })
-
-                # remove state details
-                del self.consolidated_bookings[unit][booking]['state']
-
-        for booking in bookings_to_delete:
-            del self.consolidated_bookings[booking['unit']][booking['id']]
-
-        logging.info("====")
-        logging.info(json.dumps(self.consolidated_bookings,indent=4))
-
         # save to S3
-        s3 = boto3.client('s3')
-        s3.put_object(
-            Body=json.dumps(self.consolidated_bookings),
-            Bucket=CLEANING_BUCKET_NAME,
-            Key='rentals.json'
-        )
+        self.state_store.save(self.booking_diff.to_state())
 
 
     def _get_previous_bookings(self):
         """
-        Pulls the previous booking information from a JSON file in the specified S3 bucket, then loads the JSON
-        data
+        Pulls the previous booking information from the specified S3 bucket (see state_store.py)
         :return: JSON data of previous bookings
 
         {
@@ -189,17 +274,7 @@ class CleaningNotifier:
         }
         """
 
-        s3 = boto3.resource('s3')
-
-        content_object = s3.Object(CLEANING_BUCKET_NAME, 'rentals.json')
-        file_content = content_object.get()['Body'].read().decode('utf-8')
-        json_content = json.loads(file_content)
-
-        logging.info("======== OLD BOOKING DETAILS===========")
-        logging.info(json.dumps(json_content, indent=4))
-        logging.info("=======================================")
-
-        return json_content
+        return self.state_store.load()
 
 
     def _get_current_bookings(self):
@@ -217,15 +292,34 @@ class CleaningNotifier:
         logging.info("Getting Bookings from Lodgify: {} - {}".format(start_date, end_date))
         logging.info("================")
         logging.info("")
-        bookings = self.lodgify_client.get_bookings(start_date=start_date, end_date=end_date)
-        return bookings
+        # The bulk sweep has the details of each booking too, so they don't need fetching one by one
+        self.swept = None
+        if LODGIFY_CONFIGURATION['bulk_booking_sweep']:
+            swept = self.lodgify_client.get_bookings_sweep(start_date=start_date, end_date=end_date)
+            if not isinstance(swept, list):
+                self.current_blocks = swept
+                return swept
+            self.swept = {booking.booking_id: booking for booking in swept}
+            self.current_blocks = [{
+                "booking_id": booking.booking_id,
+                "property_id": booking.property_id,
+                "period_start": booking.arrival,
+                "period_end": booking.departure
+            } for booking in swept]
+            return list(self.swept)
+
+        self.current_blocks = self.lodgify_client.get_booking_blocks(start_date=start_date, end_date=end_date)
+        if not isinstance(self.current_blocks, list):
+            return self.current_blocks
+
+        return [block['booking_id'] for block in self.current_blocks]
 
 
     def _compare_bookings(self):
         """
         Takes the current bookings from Lodgify and compares them to the previous bookings from the last run. Creates
-        a consolidated bookings value, that shows all bookings, and the status (e.g. new, cancelled, updated) for use in
-        creating the update email message body
+        a booking diff, that shows all bookings, and the status (e.g. new, cancelled, updated) for use in creating the
+        update email message body
         """
 
         logging.info("")
@@ -234,52 +328,10 @@ class CleaningNotifier:
         logging.info("================")
         logging.info("")
 
-        # Find changes from existing booking
-        logging.info("Checking previous bookings against current")
-        logging.info("-------------------")
-        for unit, bookings in self.previous_bookings.items():
-
-            if unit not in self.consolidated_bookings:
-                self.consolidated_bookings[unit] = {}
-
-            logging.info(f"{unit}")
-            for booking, details in bookings.items():
-                logging.info(f"- Checking booking: {booking}")
-
-
-                if booking not in self.consolidated_bookings[unit]:
-                    if details['check_out_date'] == datetime.now().strftime("%Y-%m-%d"):
-                        logging.info(f"-- checked out today, skipping")
-                        continue
-
-                    logging.info(f"-- cancelled (not in list of current bookings)")
-                    self.consolidated_bookings[unit][booking] = details
-                    self.consolidated_bookings[unit][booking]['state'] = "Cancelled"
-                    self.bookings_have_changed = True
-                else:
-                    if self.consolidated_bookings[unit][booking] != details:
-                        logging.info(f"-- changed (details don't match current bookings:")
-                        for key, value in details.items():
-                            logging.info(f"---- {key}: {value} (old) / {self.consolidated_bookings[unit][booking][key]} (new)")
-                        self.consolidated_bookings[unit][booking]['state'] = "Changed"
-                        self.bookings_have_changed = True
-                    else:
-                        logging.info(f"-- current (all details match)")
-                        self.consolidated_bookings[unit][booking]['state'] = "Current"
-
-        # Find new bookings
-        logging.info("Checking new bookings against old")
-        logging.info("-------------------")
-        for unit, bookings in self.consolidated_bookings.items():
-            logging.info(f"{unit}")
-            for booking in bookings:
-                logging.info(f"- Checking booking: {booking}")
-                if booking not in self.previous_bookings.get(unit, {}):
-                    logging.info(f"-- New (not in old bookings list)")
-                    self.consolidated_bookings[unit][booking]['state'] = "New"
-                    self.bookings_have_changed = True
-                else:
-                    logging.info(f"-- Current (in both lists)")
+        self.booking_diff = diff_bookings(previous=self.previous_bookings,
+                                          current=self.consolidated_bookings,
+                                          today=datetime.now().strftime("%Y-%m-%d"))
+        self.bookings_have_changed = self.booking_diff.has_changes
 
 
     def _get_details_for_current_bookings(self):
@@ -296,21 +348,28 @@ class CleaningNotifier:
         logging.info("Getting Details For Each Lodgify Booking")
         logging.info("================")
         logging.info("")
-        for entry in self.current_bookings:
-            logging.info(f"Getting details for booking {entry}")
-            booking = self.lodgify_client.get_booking_details(booking_id=entry)
+        # Only fetch bookings that are new or changed since the last run, if enabled.  The bulk sweep already has the
+        # current details for every booking.
+        self.booking_sync = None
+        if self.swept is not None:
+            all_details = [self.swept[entry] for entry in self.current_bookings]
+        else:
+            if INCREMENTAL_BOOKING_SYNC and isinstance(self.current_blocks, list):
+                self.booking_sync = BookingSync()
+                self.booking_sync.sync(self.lodgify_client, self.current_blocks)
 
-            logging.info(f"- {LISTING_MAPPING[booking['property_id']]['display_name']}, Guest: {booking['guest']['name']}")
+            all_details = self.lodgify_client.get_booking_details_many(booking_ids=self.current_bookings)
+        for entry, booking in zip(self.current_bookings, all_details):
+            logging.info(f"Got details for booking {entry}")
+
+            logging.info(f"- {booking.unit}, Guest: {booking.guest_name}")
 
             # Add to reservations dict
-            if LISTING_MAPPING[booking['property_id']]['display_name'] not in self.consolidated_bookings:
-                self.consolidated_bookings[LISTING_MAPPING[booking['property_id']]['display_name']] = {}
-            self.consolidated_bookings[LISTING_MAPPING[booking['property_id']]['display_name']][str(entry)] = {
-                "check_in_date": booking['arrival'],
-                "check_out_date": booking['departure'],
-                "name": booking['guest']['name'],
-                "status": booking['status']
-            }
+            if booking.unit not in self.consolidated_bookings:
+                self.consolidated_bookings[booking.unit] = {}
+            self.consolidated_bookings[booking.unit][str(entry)] = booking.state_entry()
+
+        self.lodgify_client.booking_cache.log_stats()
 
         logging.info("")
         logging.info("Consolidated Bookings JSON:")
@@ -321,78 +380,11 @@ class CleaningNotifier:
 
 
     def _format_slack_output(self):
-        """
-        Formats a block of markdown text to send a slack message update
-        :return: markdown formatted message body
-        """
-        logging.info("")
-        logging.info("================")
-        logging.info("Formatting Slack Message")
-        logging.info("================")
-        logging.info("")
-
-        slack_output = "\n"
-        for unit, bookings in self.consolidated_bookings.items():
-            slack_output += f"{unit}\n"
-            slack_output += "----------------------\n"
-
-            for booking, details in bookings.items():
-
-                line = f"{details['name']} - In: {details['check_in_date'][5:]}, Out: {details['check_out_date'][5:]}"
-                if details['state'] in ['Changed', 'Cancelled', 'New']:
-                    line += f" ({details['state']}!)"
-
-                line += "\n"
-                slack_output += line
-
-            slack_output += "\n"
-
-        logging.info(slack_output)
-        return slack_output
+        return format_slack_output(self.booking_diff)
 
 
     def _format_email_output(self):
-        """
-        Formats the cleaning update email, based on the booking comparison output
-        :return: HTML formatted email message body
-        """
-
-        logging.info("")
-        logging.info("================")
-        logging.info("Formatting Cleaning Email")
-        logging.info("================")
-        logging.info("")
-
-        html_email_output = ""
-
-        for unit, bookings in self.consolidated_bookings.items():
-            last_checkout = None
-            html_email_output += f"<b>{unit}</b><br>"
-            html_email_output += "----------------------<br>"
-            logging.info(f"{unit}")
-            logging.info("---------------")
-
-            for booking, details in bookings.items():
-
-                if not last_checkout:
-                    line = ""
-                elif details['check_in_date'][5:] == last_checkout:
-                    line = "&nbsp;&nbsp;&nbsp;&nbsp;(*** IS A TURNOVER CLEAN ***)<br>"
-                else:
-                    line = "<br>"
-
-                if details['state'] in ['Changed', 'Cancelled', 'New']:
-                    line += f"""<font style="color:{EMAIL_LINE_COLOR_MAPPINGS[details['state']]}";><b>In:</b> {details['check_in_date'][5:]}, <b>Out:</b> {details['check_out_date'][5:]} ({details['state']}!)</font>"""
-                else:
-                    line += f"<b>In:</b> {details['check_in_date'][5:]}, <b>Out:</b> {details['check_out_date'][5:]}"
-
-                html_email_output += line
-                last_checkout = details['check_out_date'][5:]
-
-            html_email_output += "<br><br>"
-            logging.info("")
-
-        return html_email_output
+        return format_email_output(self.booking_diff)
 
 
     def send_update_cleaning_email(self):
@@ -417,6 +409,8 @@ class CleaningNotifier:
 
         # Save updated bookings back to S3 for future comparison run
         self._save_updated_bookings()
+        if self.booking_sync:
+            self.booking_sync.save()
 
 
 
@@ -0,0 +1,44 @@
+"""
+Lambda entry point for the cleaning report.  This runs as its own lambda, on its own schedule, separate from the lock
+automation in guest_handler.py, so the longer cleaning scan has its own timeout and memory, and the lock automation can
+run more often without re-running it.  The two share state through S3: the bookings the lock automation fetched (see
+booking_cache.py) are loaded here, so they are not fetched from Lodgify again.
+"""
+
+import logging
+import retry
+from metrics import METRICS
+from http_cache import HTTP_CACHE
+from booking_cache import BookingCache
+from lodgify import Lodgify
+from cleaning_automation import CleaningNotifier
+from config import LODGIFY_CONFIGURATION
+
+##############
+# Configuration
+##############
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:  %(message)s', level=logging.INFO)
+
+
+def lambda_handler(event, context):
+    # Warm invocations keep module state, so give each run a fresh retry budget and metrics
+    retry.RETRY_BUDGET.reset()
+    METRICS.reset()
+
+    # The bulk sweep gets the details of every booking anyway, so the lock automation's bookings are only needed without it
+    booking_cache = BookingCache()
+    if not LODGIFY_CONFIGURATION['bulk_booking_sweep']:
+        booking_cache.load()
+
+    processor = CleaningNotifier(lodgify_client=Lodgify(booking_cache=booking_cache))
+    processor.send_update_cleaning_email()
+
+    HTTP_CACHE.log_stats()
+    METRICS.emit_emf(run_name="CleaningReport")
+
+
+
+if __name__ == "__main__":
+    lambda_handler("", "")
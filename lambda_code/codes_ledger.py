@@ -0,0 +1,159 @@
+"""
+Ledger of the door codes we have issued, kept as a JSON file in S3 and keyed by booking ID.  Checking the ledger is a
+single lookup, so bookings that already have a code don't need their details (and full message history) fetched from
+Lodgify at all.  Bookings with codes sent before the ledger existed are found by the old message scan, and added to
+the ledger then.
+
+A code is recorded as pending (with its PIN and lock guest ID) as soon as its guest has been created, before the email
+is sent, and recorded again once the email has gone out.  If the run stops in between, the next run finds the pending
+entry and sends that PIN again, rather than creating a second guest.
+
+The scheduled run, the fan-out workers and the webhook handler all write the ledger, so it is saved with an ETag
+conditional put.  If another writer saved it first, the ledger is reloaded and this writer's new entries merged in
+before trying again.
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+import aws_clients
+from config import CLEANING_BUCKET_NAME
+
+LEDGER_KEY = 'codes_issued.json'
+
+# Entries are dropped this many days after check-out
+LEDGER_RETENTION_DAYS = 30
+
+# Attempts to save the ledger when other writers keep saving it first
+LEDGER_SAVE_ATTEMPTS = 5
+
+
+class CodesLedger:
+
+    def __init__(self):
+        self.etag = None
+        self.entries = self._load()
+        self.recorded = {}
+        self._lock = threading.Lock()
+
+
+    def _load(self):
+        """
+        Loads the ledger from S3.  A missing file just means no codes have been recorded yet.
+        :return: dict of booking ID to ledger entry
+        """
+        s3 = aws_clients.get_client('s3')
+        try:
+            response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=LEDGER_KEY)
+        except s3.exceptions.NoSuchKey:
+            logging.info(f"No {LEDGER_KEY} found, starting a new codes ledger")
+            self.etag = None
+            return {}
+
+        self.etag = response['ETag']
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+
+    def get(self, booking_id):
+        """
+        Gets the ledger entry for a booking
+        :param booking_id: Booking to look up
+        :return: dict, ex:
+
+            {
+                "pin": 12345,
+                "lock_guest_id": "<REMOTELOCK GUEST ID>",
+                "issued_at": "2022-05-26T14:04:51",
+                "unit": "Unit X",
+                "guest_name": "Mark B",
+                "arrival": "2022-05-27",
+                "departure": "2022-05-29",
+                "pending": false
+            }
+
+            or None if no code has been recorded for the booking
+        """
+        return self.entries.get(str(booking_id))
+
+
+    def issued(self, booking_id):
+        """
+        Gets the ledger entry for a booking whose door code has been sent
+        :param booking_id: Booking to look up
+        :return: dict, as get returns, or None if no code has been sent for the booking
+        """
+        entry = self.entries.get(str(booking_id))
+        if entry is None or entry.get('pending'):
+            return None
+        return entry
+
+
+    def pending(self, booking_id):
+        """
+        Gets the ledger entry for a booking whose guest and PIN were created, but whose email has not been sent yet
+        :param booking_id: Booking to look up
+        :return: dict, as get returns, or None if the booking has no pending code
+        """
+        entry = self.entries.get(str(booking_id))
+        if entry is None or not entry.get('pending'):
+            return None
+        return entry
+
+
+    def record(self, booking_id, unit, guest_name, arrival, departure, pin=None, lock_guest_id=None, pending=False):
+        """
+        Records that a door code has been sent for a booking.  pin and lock_guest_id are None for codes found by the
+        message scan, as those were issued before the ledger existed.  Set pending to True when the code has been
+        created, but the email with it not sent yet.
+        """
+        with self._lock:
+            entry = {
+                "pin": pin,
+                "lock_guest_id": lock_guest_id,
+                "issued_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                "unit": unit,
+                "guest_name": guest_name,
+                "arrival": arrival,
+                "departure": departure,
+                "pending": pending
+            }
+            self.entries[str(booking_id)] = entry
+            self.recorded[str(booking_id)] = entry
+
+
+    def save(self):
+        """
+        Drops entries for stays that ended long ago, then saves the ledger to S3 if anything changed.  If another run
+        saved the ledger since it was loaded, their entries are merged with the ones recorded here.
+        :return: True if saved (or there was nothing to save), False if other writers kept getting in first
+        """
+        cutoff = (datetime.now() - timedelta(days=LEDGER_RETENTION_DAYS)).strftime("%Y-%m-%d")
+        s3 = aws_clients.get_client('s3')
+        with self._lock:
+            for attempt in range(LEDGER_SAVE_ATTEMPTS):
+                expired = [booking_id for booking_id, entry in self.entries.items() if entry['departure'] < cutoff]
+                for booking_id in expired:
+                    del self.entries[booking_id]
+
+                if not self.recorded and not expired:
+                    return True
+
+                # Only replace the ledger if it is still the one we loaded
+                conditions = {"IfMatch": self.etag} if self.etag else {"IfNoneMatch": "*"}
+                try:
+                    response = s3.put_object(Body=json.dumps(self.entries), Bucket=CLEANING_BUCKET_NAME,
+                                             Key=LEDGER_KEY, **conditions)
+                except s3.exceptions.ClientError as e:
+                    if e.response['Error']['Code'] not in ["PreconditionFailed", "ConditionalRequestConflict"]:
+                        raise
+                    logging.info(f"{LEDGER_KEY} was saved by another run, merging and trying again")
+                    self.entries = dict(self._load(), **self.recorded)
+                    continue
+
+                self.etag = response['ETag']
+                self.recorded = {}
+                return True
+
+        logging.error(f"ERROR! Could not save {LEDGER_KEY}, other runs kept saving it first")
+        return False
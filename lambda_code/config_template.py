@@ -8,7 +8,8 @@ Rename this file to config.py, and fill out each section, based on your environm
 EMAIL_CONFIGURATION = {
     "error_reporting_destination": "",
     "bcc_addresses": [],
-    "from_address": ""
+    "from_address": "",
+    "door_code_template_name": "LodgifyDoorCode"
 }
 
 CODE_EMAIL_TEMPLATE="""
@@ -22,11 +23,65 @@ Please note the following:<br>
 We hope you enjoy your stay!
 """
 
+################
+# Lodgify Configuration
+################
+# Set "stream_availability" to parse the availability calendar as it downloads (needs ijson in the dependency layer,
+# the whole response is parsed at once without it).  Set "bulk_booking_sweep" to get bookings and their details from
+# one paged sweep of the v2 bookings list, instead of the availability calendar and a few requests per booking.  The
+# sweep can only limit the list by departure date, so it pages through every booking from the start of the window on,
+# and suits windows that reach most of the future bookings (it is off by default for the short door code window).
+LODGIFY_CONFIGURATION = {
+    "max_concurrent_requests": 8,
+    "stream_availability": True,
+    "bulk_booking_sweep": False,
+    "sweep_page_size": 50
+}
+
+################
+# HTTP Configuration
+################
+# Timeout is in seconds.  Pool sizes are the number of kept-alive connections per host, and the Lodgify pool should be
+# at least as large as max_concurrent_requests above.  GET responses with an ETag or Last-Modified header are cached in
+# the cache directory (up to max_entries and max_bytes), and revalidated with conditional requests.
+HTTP_CONFIGURATION = {
+    "timeout": 30,
+    "pool_sizes": {
+        "https://api.lodgify.com/": 8,
+        "https://api.remotelock.com/": 2,
+        "https://connect.remotelock.com/": 1,
+        "https://hooks.slack.com/": 1
+    },
+    "cache": {
+        "enabled": True,
+        "directory": "/tmp/http_cache",
+        "max_entries": 2000,
+        "max_bytes": 100 * 1024 * 1024
+    }
+}
+
+################
+# Retry Configuration
+################
+# Delays are in seconds.  run_budget is the max number of retries across all calls in one run, and rate limits are
+# requests per second (with a burst allowance) per API host
+RETRY_CONFIGURATION = {
+    "max_attempts": 4,
+    "base_delay": 0.5,
+    "max_delay": 20,
+    "run_budget": 50,
+    "rate_limits": {
+        "https://api.lodgify.com/": {"rate": 5, "burst": 8},
+        "https://api.remotelock.com/": {"rate": 5, "burst": 5}
+    }
+}
+
 ################
 # AWS Configuration
 ################
 AWS_CONFIGURATION = {
-    "region": "us-east-1"
+    "region": "us-east-1",
+    "metrics_namespace": "LodgifyLockAutomation"
 }
 
 #################
@@ -54,7 +109,8 @@ LISTING_MAPPING = {
 EMAIL_LINE_COLOR_MAPPINGS = {
     "Cancelled": "red",
     "Changed": "orange",
-    "New": "green"
+    "New": "green",
+    "Double Booked": "red"
 }
 
 DAYS_IN_FUTURE_TO_CHECK = 2
@@ -62,6 +118,25 @@ DAYS_IN_FUTURE_FOR_CLEANINGS = 45
 CLEANING_EMAIL_DESTINATIONS = []
 CLEANING_BUCKET_NAME = "oscodaautomation"
 
+# Only fetch details for bookings that are new or changed since the last run (state saved next to rentals.json).  Edits
+# that don't move a booking's dates (ex: the guest's name) can't be seen without fetching it, so saved details are also
+# fetched again once they are older than the max age, and such edits show up in the cleaning report within that time.
+INCREMENTAL_BOOKING_SYNC = True
+INCREMENTAL_BOOKING_SYNC_MAX_AGE_HOURS = 72
+
+# Bookings fetched by the lock automation are saved to S3, and reused by the cleaning report if they were fetched within
+# this many minutes.  Set to 0 to always fetch fresh details.
+SHARED_BOOKING_CACHE_MAX_AGE_MINUTES = 60
+
+#################
+# Pipeline Configuration
+#################
+# Set "async" to True to process bookings concurrently (the steps for each booking still run in order)
+PIPELINE_CONFIGURATION = {
+    "async": False,
+    "max_concurrent_bookings": 4
+}
+
 #################
 # Lock Configuration
 #################
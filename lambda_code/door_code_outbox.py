@@ -0,0 +1,174 @@
+"""
+Batched delivery of door code emails.  Messages are queued as bookings are processed, and sent with SES bulk templated
+sends, up to 50 destinations per call, instead of one send_email call per guest.  A batch is sent as soon as it is
+full, and the rest when the outbox is flushed at the end of the run, so a run that times out only leaves its last
+batch unsent.  If the outbox has a codes ledger, each code is recorded there as pending when it is queued, and the
+ledger saved once before each batch is sent, so the next run sends an unsent code again instead of creating another
+one.  The SES template is built from
+CODE_EMAIL_TEMPLATE and kept in sync with it.
+"""
+
+import json
+import logging
+import threading
+import aws_clients
+from config import CODE_EMAIL_TEMPLATE, EMAIL_CONFIGURATION, RENTAL_CONFIGURATION
+
+# SES limit on destinations per send_bulk_templated_email call
+MAX_DESTINATIONS_PER_SEND = 50
+
+# Template content last synced to SES, kept across warm invocations so the template is only checked once
+_synced_template = None
+
+
+def build_template():
+    """
+    Builds the SES template for door code emails from CODE_EMAIL_TEMPLATE
+    :return: dict in the format SES expects for create_template/update_template
+    """
+    body = CODE_EMAIL_TEMPLATE.format("{{code}}", RENTAL_CONFIGURATION['check_in_time'],
+                                      RENTAL_CONFIGURATION['check_out_time'])
+    return {
+        "TemplateName": EMAIL_CONFIGURATION['door_code_template_name'],
+        "SubjectPart": "Door code for {{guest_name}}, {{unit}}",
+        "HtmlPart": body,
+        "TextPart": body
+    }
+
+
+def ensure_template():
+    """
+    Creates the SES door code template, or updates it if CODE_EMAIL_TEMPLATE or the check in/out times have changed
+    """
+    global _synced_template
+
+    template = build_template()
+    if template == _synced_template:
+        return
+
+    client = aws_clients.get_client('ses')
+    try:
+        existing = client.get_template(TemplateName=template['TemplateName'])['Template']
+    except client.exceptions.TemplateDoesNotExistException:
+        logging.info(f"Creating SES template {template['TemplateName']}")
+        client.create_template(Template=template)
+    else:
+        if any(existing.get(key) != value for key, value in template.items()):
+            logging.info(f"Updating SES template {template['TemplateName']}")
+            client.update_template(Template=template)
+
+    _synced_template = template
+
+
+class DoorCodeOutbox:
+
+    def __init__(self, ledger=None):
+        """
+        :param ledger: CodesLedger to record queued codes in as pending, if any
+        """
+        self.ledger = ledger
+        self.messages = []
+        self.sent = {}
+        self._lock = threading.Lock()
+
+
+    def add(self, booking_id, recipient, guest_name, unit, code, ledger_entry=None):
+        """
+        Queues a door code email, sending the queued emails if there is a full batch
+        :param booking_id: Booking the email is for, used to map the send result back
+        :param recipient: Email recipient
+        :param guest_name: Guest name, for the subject
+        :param unit: Unit display name, for the subject
+        :param code: Door code to send
+        :param ledger_entry: dict of CodesLedger.record arguments for the code, to record it as pending
+        """
+        if self.ledger is not None and ledger_entry:
+            self.ledger.record(booking_id=booking_id, pending=True, **ledger_entry)
+
+        with self._lock:
+            self.messages.append({
+                "booking_id": booking_id,
+                "recipient": recipient,
+                "data": {
+                    "guest_name": guest_name,
+                    "unit": unit,
+                    "code": str(code)
+                }
+            })
+            batch = []
+            if len(self.messages) >= MAX_DESTINATIONS_PER_SEND:
+                batch, self.messages = self.messages, []
+
+        if batch:
+            sent = self._send(batch)
+            with self._lock:
+                self.sent.update(sent)
+
+
+    def flush(self):
+        """
+        Sends the emails still queued, and empties the outbox
+        :return: dict of booking ID to True, or an "ERROR: ..." string if the email for that booking failed, for every
+            email queued since the last flush
+        """
+        with self._lock:
+            messages, self.messages = self.messages, []
+        sent = self._send(messages) if messages else {}
+
+        with self._lock:
+            self.sent.update(sent)
+            sent, self.sent = self.sent, {}
+        return sent
+
+
+    def _send(self, messages):
+        """
+        Sends emails in bulk, after saving the batch's pending codes to the ledger
+        :param messages: List of queued messages
+        :return: dict of booking ID to True, or an "ERROR: ..." string
+        """
+        if self.ledger is not None:
+            self.ledger.save()
+
+        sent = {}
+        try:
+            ensure_template()
+        except Exception as e:
+            for message in messages:
+                sent[message['booking_id']] = "ERROR: Could not send email to user: {} Got error: {}".format(message['recipient'], e)
+            return sent
+
+        client = aws_clients.get_client('ses')
+        for start in range(0, len(messages), MAX_DESTINATIONS_PER_SEND):
+            chunk = messages[start:start + MAX_DESTINATIONS_PER_SEND]
+            try:
+                response = client.send_bulk_templated_email(
+                    Source=EMAIL_CONFIGURATION['from_address'],
+                    Template=EMAIL_CONFIGURATION['door_code_template_name'],
+                    DefaultTemplateData=json.dumps({"guest_name": "", "unit": "", "code": ""}),
+                    Destinations=[
+                        {
+                            "Destination": {
+                                "ToAddresses": [message['recipient']],
+                                "BccAddresses": EMAIL_CONFIGURATION['bcc_addresses']
+                            },
+                            "ReplacementTemplateData": json.dumps(message['data'])
+                        }
+                        for message in chunk
+                    ]
+                )
+            except Exception as e:
+                for message in chunk:
+                    sent[message['booking_id']] = "ERROR: Could not send email to user: {} Got error: {}".format(message['recipient'], e)
+                continue
+
+            # Statuses come back in the same order as the destinations
+            for message, status in zip(chunk, response['Status']):
+                if status.get('Status', "Success") == "Success" and status.get('MessageId'):
+                    sent[message['booking_id']] = True
+                else:
+                    sent[message['booking_id']] = "ERROR: Could not send email to user: {} Got error: {} {}".format(
+                        message['recipient'], status.get('Status'), status.get('Error', ''))
+
+        logging.info(f"Sent {len(messages)} door code emails in {(len(messages) - 1) // MAX_DESTINATIONS_PER_SEND + 1} bulk sends")
+        return sent
@@ -0,0 +1,317 @@
+"""
+Fan-out mode for the lock automation, for when there are too many bookings to process in one lambda invocation.
+
+coordinator_handler runs on the schedule in place of guest_handler.lambda_handler.  It lists the bookings in the window,
+settles the ones the codes ledger already has a code for, and queues one message per unit with the rest of that unit's
+bookings.  worker_handler is triggered by the queue, and runs the same door code steps as lambda_handler for each of
+the unit's bookings.  Each booking is claimed in S3 (with a conditional put) before anything is done for it, so a
+message delivered twice, or two deliveries running at once, never create a second guest or send a second email.  As
+soon as a booking is done its code is recorded in the ledger and its outcome saved to S3.  Whichever invocation saves
+the last outcome of the run aggregates them, and sends the errors email and Slack message, the same as lambda_handler
+does.
+
+A booking that was claimed but never finished (the worker timed out or crashed partway through the unit) is not tried
+again, as its guest may already have been created.  It is reported as an error when the message is redelivered, or by
+dead_letter_handler, which is triggered by the queue's dead letter queue, so the run is still aggregated.
+
+To run the whole fan-out locally, with an in-process queue in place of SQS:
+
+    python fanout_handler.py
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import uuid
+import retry
+from metrics import METRICS
+import aws_clients
+from lock import Lock
+from lodgify import Lodgify
+from door_code_outbox import DoorCodeOutbox
+from codes_ledger import CodesLedger
+from work_queue import SqsQueue, LocalQueue
+from guest_handler import process_booking, already_issued_outcome, settle_outcome, report_errors, send_slack_output
+from config import CLEANING_BUCKET_NAME, DAYS_IN_FUTURE_TO_CHECK, LISTING_MAPPING
+
+FANOUT_PREFIX = 'fanout/'
+
+
+def _run_key(run_id, *parts):
+    return FANOUT_PREFIX + "/".join([run_id, *parts])
+
+
+def _put_once(key, body):
+    """
+    Writes an object only if it doesn't exist yet
+    :return: True if this call wrote it, False if it was already there
+    """
+    s3 = aws_clients.get_client('s3')
+    try:
+        s3.put_object(Body=body, Bucket=CLEANING_BUCKET_NAME, Key=key, IfNoneMatch="*")
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ["PreconditionFailed", "ConditionalRequestConflict"]:
+            return False
+        raise
+    return True
+
+
+def _save_outcome(run_id, booking_id, outcome):
+    """
+    Saves a booking's settled outcome, as returned by settle_outcome
+    """
+    s3 = aws_clients.get_client('s3')
+    s3.put_object(
+        Body=json.dumps(outcome),
+        Bucket=CLEANING_BUCKET_NAME,
+        Key=_run_key(run_id, "outcomes", "{}.json".format(booking_id))
+    )
+
+
+def _save_unfinished_outcome(run_id, booking_id, unit, reason):
+    """
+    Saves an error outcome for a booking that was not processed, unless it has an outcome already
+    :param reason: Why it was not processed, for the error line
+    """
+    _put_once(_run_key(run_id, "outcomes", "{}.json".format(booking_id)), json.dumps({
+        "codes_sent": [],
+        "codes_skipped": [],
+        "errors": ["ERROR: Booking {} for {} was not processed, {}.  Check RemoteLock for a guest created for it before "
+                   "sending a code by hand.".format(booking_id, unit, reason)],
+        "ledger_entry": None
+    }))
+
+
+def _settled_bookings(run_id):
+    """
+    Lists the bookings that have an outcome saved for the run
+    :param run_id: The run to look up
+    :return: set of booking ID strings
+    """
+    s3 = aws_clients.get_client('s3')
+    prefix = _run_key(run_id, "outcomes", "")
+    settled = set()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=CLEANING_BUCKET_NAME, Prefix=prefix):
+        for item in page.get('Contents', []):
+            settled.add(item['Key'][len(prefix):-len(".json")])
+    return settled
+
+
+def _load_json(key):
+    s3 = aws_clients.get_client('s3')
+    response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def aggregate_run(run_id):
+    """
+    Sends the results of the run, if every booking has an outcome saved.  Only the first caller to find the run
+    complete sends them.
+    :param run_id: The run to aggregate
+    :return: True if this call sent the results, False otherwise
+    """
+    manifest = _load_json(_run_key(run_id, "manifest.json"))
+    settled = _settled_bookings(run_id)
+    if any(str(entry) not in settled for entry in manifest['queued']):
+        return False
+
+    # Claim the run, so it is only aggregated once when workers finish at the same time
+    if not _put_once(_run_key(run_id, "aggregated"), datetime.now().isoformat()):
+        logging.info(f"Run {run_id} was already aggregated")
+        return False
+
+    logging.info("")
+    logging.info("================")
+    logging.info(f"Aggregating Run {run_id}")
+    logging.info("================")
+    logging.info("")
+    results = {
+        "codes_sent": [],
+        "codes_skipped": []
+    }
+    errors = []
+
+    # Outcomes are merged in booking order, however the units were spread over the workers.  Their codes were already
+    # recorded in the ledger by the workers.
+    for entry in manifest['bookings']:
+        if str(entry) in manifest['settled']:
+            outcome = manifest['settled'][str(entry)]
+        else:
+            outcome = _load_json(_run_key(run_id, "outcomes", "{}.json".format(entry)))
+
+        results['codes_sent'].extend(outcome['codes_sent'])
+        results['codes_skipped'].extend(outcome['codes_skipped'])
+        errors.extend(outcome['errors'])
+
+    if errors:
+        report_errors(errors)
+    send_slack_output(results, errors)
+    return True
+
+
+def coordinator_handler(event, context, queue=None):
+    """
+    Lists the bookings in the window, and queues each unit's bookings for the workers
+    :param queue: Queue to send the work to, defaults to the SQS queue in the FANOUT_QUEUE_URL environment variable
+    :return: The run ID
+    """
+    retry.RETRY_BUDGET.reset()
+    METRICS.reset()
+
+    if queue is None:
+        queue = SqsQueue(os.getenv("FANOUT_QUEUE_URL"))
+
+    start_date = datetime.now().strftime("%m-%d-%Y")
+    end_date = (datetime.now() + timedelta(days=DAYS_IN_FUTURE_TO_CHECK)).strftime("%m-%d-%Y")
+    run_id = "{}-{}".format(datetime.now().strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8])
+
+    logging.info("================")
+    logging.info("Getting Bookings from Lodgify: {} - {}".format(start_date, end_date))
+    logging.info("================")
+    logging.info("")
+    blocks = Lodgify().get_booking_blocks(start_date=start_date, end_date=end_date)
+
+    if not isinstance(blocks, list):
+        report_errors([blocks])
+        return None
+
+    # Bookings the ledger already has a code for are settled here, the rest are queued, grouped by unit
+    ledger = CodesLedger()
+    bookings = []
+    settled = {}
+    units = {}
+    for block in blocks:
+        entry = block['booking_id']
+        if entry in units.get(block['property_id'], []) or str(entry) in settled:
+            continue
+        bookings.append(entry)
+        if ledger.issued(entry):
+            settled[str(entry)] = settle_outcome(already_issued_outcome(ledger.issued(entry)), None)
+        else:
+            units.setdefault(block['property_id'], []).append(entry)
+
+    messages = [{"run_id": run_id, "property_id": property_id, "booking_ids": entries}
+                for property_id, entries in units.items()]
+    manifest = {
+        "bookings": bookings,
+        "settled": settled,
+        "queued": [entry for message in messages for entry in message['booking_ids']]
+    }
+    s3 = aws_clients.get_client('s3')
+    s3.put_object(Body=json.dumps(manifest), Bucket=CLEANING_BUCKET_NAME, Key=_run_key(run_id, "manifest.json"))
+
+    logging.info(f"Run {run_id}: {len(settled)} bookings already have codes, queueing {len(manifest['queued'])} "
+                 f"bookings for {len(messages)} units")
+    failed = queue.send(messages)
+
+    # Bookings that could not be queued get an error outcome, so the run can still be aggregated
+    for message in failed:
+        for entry in message['booking_ids']:
+            _save_outcome(run_id, entry, {
+                "codes_sent": [],
+                "codes_skipped": [],
+                "errors": ["ERROR: Could not queue booking {} for {}".format(entry, LISTING_MAPPING[message['property_id']]['display_name'])],
+                "ledger_entry": None
+            })
+
+    # If nothing needed queueing, there are no workers to aggregate the run
+    aggregate_run(run_id)
+
+    METRICS.emit_emf(run_name="LockCoordinator")
+    return run_id
+
+
+def process_unit(message, redelivered=False):
+    """
+    Runs the door code steps for each of a unit's bookings in a work message, saving each booking's outcome as soon as
+    it is done
+    :param message: dict, as queued by coordinator_handler
+    :param redelivered: True if SQS has delivered the message before, so any booking claimed but without an outcome
+        was left unfinished by an earlier delivery
+    """
+    run_id = message['run_id']
+    unit = LISTING_MAPPING[message['property_id']]['display_name']
+
+    # SQS can deliver a message more than once, so skip any booking that already has an outcome
+    done = _settled_bookings(run_id)
+    bookings = [entry for entry in message['booking_ids'] if str(entry) not in done]
+    logging.info(f"Run {run_id}: processing {len(bookings)} bookings for {unit}")
+    if not bookings:
+        return
+
+    Lodge = Lodgify()
+    locks = Lock()
+    ledger = CodesLedger()
+    all_details = Lodge.get_booking_details_many(booking_ids=bookings)
+    for entry, booking in zip(bookings, all_details):
+
+        # Claim the booking before anything is done for it, so no other delivery of the message processes it too
+        if not _put_once(_run_key(run_id, "claims", str(entry)), datetime.now().isoformat()):
+            if redelivered:
+                _save_unfinished_outcome(run_id, entry, unit, "an earlier delivery of its work message stopped partway")
+            else:
+                logging.info(f"Booking {entry} was claimed by another delivery, skipping")
+            continue
+
+        # Send the booking's email straight away, so nothing is left unsent if the worker stops later in the unit
+        outbox = DoorCodeOutbox(ledger=ledger)
+        outcome = process_booking(entry, booking, Lodge, locks, outbox, ledger.pending(entry))
+        outcome = settle_outcome(outcome, outbox.flush().get(entry))
+
+        if outcome['ledger_entry']:
+            ledger.record(booking_id=entry, **outcome['ledger_entry'])
+            ledger.save()
+        _save_outcome(run_id, entry, outcome)
+
+
+def worker_handler(event, context):
+    """
+    Processes the work messages in an SQS event, then aggregates each run if these were its last bookings
+    """
+    retry.RETRY_BUDGET.reset()
+    METRICS.reset()
+
+    run_ids = []
+    for record in event['Records']:
+        message = json.loads(record['body'])
+        receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+        process_unit(message, redelivered=receive_count > 1)
+        if message['run_id'] not in run_ids:
+            run_ids.append(message['run_id'])
+
+    for run_id in run_ids:
+        aggregate_run(run_id)
+
+    METRICS.emit_emf(run_name="LockWorker")
+
+
+def dead_letter_handler(event, context):
+    """
+    Reports the bookings of work messages that ended up in the dead letter queue as errors, then aggregates their runs,
+    which would otherwise never be complete
+    """
+    retry.RETRY_BUDGET.reset()
+    METRICS.reset()
+
+    run_ids = []
+    for record in event['Records']:
+        message = json.loads(record['body'])
+        unit = LISTING_MAPPING[message['property_id']]['display_name']
+        done = _settled_bookings(message['run_id'])
+        for entry in message['booking_ids']:
+            if str(entry) not in done:
+                _save_unfinished_outcome(message['run_id'], entry, unit, "its work message went to the dead letter queue")
+        if message['run_id'] not in run_ids:
+            run_ids.append(message['run_id'])
+
+    for run_id in run_ids:
+        aggregate_run(run_id)
+
+    METRICS.emit_emf(run_name="LockDeadLetter")
+
+
+if __name__ == "__main__":
+    local_queue = LocalQueue()
+    coordinator_handler("", "", queue=local_queue)
+    local_queue.drain(worker_handler)
@@ -1,14 +1,18 @@
 from datetime import datetime, timedelta
-import requests
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import http_session
+import retry
+from metrics import METRICS
+from http_cache import HTTP_CACHE
+import aws_clients
 from lock import Lock
 from lodgify import Lodgify
+from door_code_outbox import DoorCodeOutbox
+from codes_ledger import CodesLedger
 import os
 import logging
-from config import CODE_EMAIL_TEMPLATE, RENTAL_CONFIGURATION, DAYS_IN_FUTURE_TO_CHECK, LISTING_MAPPING, \
-    AWS_CONFIGURATION, EMAIL_CONFIGURATION
-
-from cleaning_automation import CleaningNotifier, send_email, send_cleaning_slack_output
+from config import DAYS_IN_FUTURE_TO_CHECK, EMAIL_CONFIGURATION, PIPELINE_CONFIGURATION, LODGIFY_CONFIGURATION
 
 ##############
 # Configuration
@@ -24,7 +28,7 @@ def report_errors(errors):
     :param errors:
     :return:
     """
-    client = boto3.client('ses', region_name=AWS_CONFIGURATION['region'])
+    client = aws_clients.get_client('ses')
     res = client.send_email(
         Source=EMAIL_CONFIGURATION['from_address'],
         Destination={
@@ -103,12 +107,250 @@ def send_slack_output(results, errors):
             }
         )
 
+    api_calls = METRICS.slack_text()
+    if api_calls:
+        message['blocks'].append(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "*API Calls*\n-----------------\n{}".format(api_calls)
+                }
+            }
+        )
+
+    if results.get('pin_space'):
+        message['blocks'].append(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "*PIN Space*\n-----------------\n{}".format(results['pin_space'])
+                }
+            }
+        )
+
     headers = {
         "Accept": "application/json",
         "Content-type": "application/json"
     }
-    response = requests.post(os.getenv("SLACK_WEBHOOK"), headers=headers, json=message)
+    response = http_session.post(os.getenv("SLACK_WEBHOOK"), headers=headers, json=message)
+
+
+
+def process_booking(entry, booking, Lodge, locks, outbox, pending=None):
+    """
+    Runs the door code steps for one booking: checks if a code is needed, creates the lock guest and PIN, then
+    queues the renter's email in the outbox
+    :param entry: The booking ID
+    :param booking: BookingRecord (or an "ERROR: ..." string) from Lodgify.get_booking_details
+    :param Lodge: Lodgify client
+    :param locks: Lock client
+    :param outbox: DoorCodeOutbox the renter's email is queued in
+    :param pending: dict from CodesLedger.pending, if an earlier run created the booking's code but didn't send it
+    :return: dict of the lines this booking adds to the results and errors.  code_queued holds the "Codes Sent" line
+        for a queued email, which only counts as sent once the outbox has been flushed, and ledger_entry holds what
+        should be recorded in the codes ledger once it does.
+    """
+    outcome = {
+        "codes_sent": [],
+        "codes_skipped": [],
+        "errors": [],
+        "code_queued": None,
+        "ledger_entry": None
+    }
+
+    if isinstance(booking, str):
+        outcome['errors'].append(booking)
+        return outcome
+
+    logging.info("{}, Guest: {}".format(booking.unit, booking.guest_name))
+
+    # Skip rentals without remote locks
+    if not booking.lock_device_id:
+        logging.info(f"-- No action, no remote lock for {booking.unit}")
+        return outcome
+
+    # Skip any that are not "booked" status, they wouldn't need a door code yet
+    if booking.status != "Booked":
+        logging.info("-- No action, reservation not booked (no payment yet?)")
+        outcome['codes_skipped'].append("*Property:* {}, *Guest:* {} {}-{} (No yet paid?)\n".format(booking.unit, booking.guest_name,
+                                                                                                    booking.arrival, booking.departure))
+        return outcome
+
+    # Bookings from the bulk sweep don't include their messages, so get them before deciding if a code is needed
+    if booking.code_sent is None:
+        booking = Lodge.get_booking_details(booking_id=entry, use_cache=False)
+        if isinstance(booking, str):
+            outcome['errors'].append(booking)
+            return outcome
+
+    # Check to see if we've previously sent a door code message to this user (found in the booking's messages when
+    # it was parsed)
+    code_sent = bool(booking.code_sent)
+    if code_sent:
+        logging.info("--- Code already sent!")
+        outcome['codes_skipped'].append("*Property:* {}, *Guest:* {} {}-{} (Already sent)\n".format(booking.unit, booking.guest_name,
+                                                                                                    booking.arrival, booking.departure))
+        # Add it to the ledger, so the next run doesn't need to check the messages again
+        outcome['ledger_entry'] = {
+            "unit": booking.unit,
+            "guest_name": booking.guest_name,
+            "arrival": booking.arrival,
+            "departure": booking.departure
+        }
+
+    # Create and send a door code if not already done
+    if not code_sent:
+        logging.info("--- Must create and send a new code.")
+
+        # Get recipient email address
+        recipient_email = Lodge.get_booking_email(booking_id=entry)
+
+        # Throw error if we can't get the email
+        if "ERROR:" in recipient_email:
+            outcome['errors'].append(recipient_email)
+            return outcome
+
+        if LIVE:
+            if pending and pending.get('pin'):
+                # An earlier run created the guest and PIN, but stopped before the email was sent, so send that PIN
+                logging.info("----- Code created by an earlier run, not yet sent")
+                user_create = {"pin": pending['pin'], "guest_id": pending['lock_guest_id']}
+            else:
+                # Create the guest and PIN
+                user_create = locks.create_new_guest(name=booking.guest_name,
+                                                     email=booking.guest_email,
+                                                     start=booking.arrival,
+                                                     end=booking.departure,
+                                                     device_id=booking.lock_device_id)
+
+            # Throw error if we can't create the user on the lock
+            if isinstance(user_create, str):
+                if "ERROR:" in user_create:
+                    outcome['errors'].append(user_create)
+                    return outcome
+
+            outcome['code_queued'] = "*Property:* {}, *Guest:* {} {}-{}\n".format(booking.unit, booking.guest_name,
+                                                                                  booking.arrival, booking.departure)
+            outcome['ledger_entry'] = {
+                "unit": booking.unit,
+                "guest_name": booking.guest_name,
+                "arrival": booking.arrival,
+                "departure": booking.departure,
+                "pin": user_create['pin'],
+                "lock_guest_id": user_create['guest_id']
+            }
+
+            # Queue the renter's message with the door code, it is sent once there is a full batch, or when the outbox
+            # is flushed.  The code is recorded in the ledger as pending, and saved before its batch is sent, so it
+            # isn't created again if the run stops.
+            outbox.add(booking_id=entry,
+                       recipient=recipient_email,
+                       guest_name=booking.guest_name,
+                       unit=booking.unit,
+                       code=user_create['pin'],
+                       ledger_entry=outcome['ledger_entry'])
+
+            logging.info("----- Created code for user, effective {} - {}".format(booking.arrival, booking.departure))
+        else:
+            logging.info("----- TESTING MODE: Would create and message code to this user.")
+
+    return outcome
+
+
+def needs_message_scan(booking):
+    """
+    Checks if process_booking will need to know if a booking's messages include a sent code.  Bookings from the bulk
+    sweep don't include their messages, so those that will need their v1 details fetched.
+    :param booking: BookingRecord, from Lodgify.get_bookings_sweep
+    :return: True or False
+    """
+    return booking.status == "Booked" and bool(booking.lock_device_id) and booking.code_sent is None
+
+
+def already_issued_outcome(ledger_entry):
+    """
+    Builds the outcome for a booking the codes ledger says already has a code, without fetching it from Lodgify
+    :param ledger_entry: dict from CodesLedger.issued
+    :return: dict in the same format as process_booking returns
+    """
+    logging.info("{}, Guest: {}".format(ledger_entry['unit'], ledger_entry['guest_name']))
+    logging.info("--- Code already sent! (in codes ledger)")
+    return {
+        "codes_sent": [],
+        "codes_skipped": ["*Property:* {}, *Guest:* {} {}-{} (Already sent)\n".format(ledger_entry['unit'], ledger_entry['guest_name'],
+                                                                                     ledger_entry['arrival'], ledger_entry['departure'])],
+        "errors": [],
+        "code_queued": None,
+        "ledger_entry": None
+    }
+
+
+def settle_outcome(outcome, email_sent):
+    """
+    Folds the result of sending a booking's door code email into its outcome, once the outbox has been flushed
+    :param outcome: dict, as returned by process_booking
+    :param email_sent: True or an "ERROR: ..." string, from DoorCodeOutbox.flush, or None if no email was queued
+    :return: dict of codes_sent, codes_skipped and errors lines, and the ledger_entry to record (None if there is
+        nothing to record)
+    """
+    settled = {
+        "codes_sent": list(outcome['codes_sent']),
+        "codes_skipped": list(outcome['codes_skipped']),
+        "errors": list(outcome['errors']),
+        "ledger_entry": outcome['ledger_entry']
+    }
+
+    if outcome['code_queued']:
+        if email_sent is True:
+            settled['codes_sent'].append(outcome['code_queued'])
+        else:
+            settled['errors'].append(email_sent)
+            settled['ledger_entry'] = None
 
+    return settled
+
+
+async def _process_booking_async(entry, Lodge, locks, outbox, ledger, semaphore, swept, executor):
+    """
+    Fetches and processes one booking on a worker thread from the executor, once a slot in the semaphore is free
+    """
+    import asyncio
+
+    if ledger.issued(entry):
+        return already_issued_outcome(ledger.issued(entry))
+
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        booking = swept.get(entry)
+        if booking is None or needs_message_scan(booking):
+            booking = await loop.run_in_executor(executor, partial(Lodge.get_booking_details, booking_id=entry))
+        return await loop.run_in_executor(executor, process_booking, entry, booking, Lodge, locks, outbox,
+                                          ledger.pending(entry))
+
+
+async def process_bookings_async(bookings, Lodge, locks, outbox, ledger, swept=None):
+    """
+    Processes bookings concurrently, up to the configured number at a time.  The steps for each booking still run in
+    order.
+    :param bookings: List of booking IDs
+    :param Lodge: Lodgify client
+    :param locks: Lock client
+    :param outbox: DoorCodeOutbox renter emails are queued in
+    :param ledger: CodesLedger of bookings that already have a code
+    :param swept: dict of booking ID to BookingRecord from the bulk sweep, if it was used
+    :return: list of outcomes from process_booking, in the same order as bookings
+    """
+    import asyncio
+
+    # A pool of our own, as asyncio's default executor would cap the concurrency at min(32, CPUs + 4) threads
+    max_concurrent = PIPELINE_CONFIGURATION['max_concurrent_bookings']
+    semaphore = asyncio.Semaphore(max_concurrent)
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        return await asyncio.gather(*[_process_booking_async(entry, Lodge, locks, outbox, ledger, semaphore,
+                                                             swept or {}, executor)
+                                      for entry in bookings])
 
 
 def lambda_handler(event, context):
@@ -118,6 +360,10 @@ def lambda_handler(event, context):
     }
     errors = []
 
+    # Warm invocations keep module state, so give each run a fresh retry budget and metrics
+    retry.RETRY_BUDGET.reset()
+    METRICS.reset()
+
     # Get start and end dates to search
     start_date = datetime.now().strftime("%m-%d-%Y")
     end_date = (datetime.now() + timedelta(days=DAYS_IN_FUTURE_TO_CHECK)).strftime("%m-%d-%Y")
@@ -131,7 +377,16 @@ def lambda_handler(event, context):
     logging.info("Getting Bookings from Lodgify: {} - {}".format(start_date, end_date))
     logging.info("================")
     logging.info("")
-    bookings = Lodge.get_bookings(start_date=start_date, end_date=end_date)
+    # The bulk sweep has most of the details for each booking as well, so only bookings that need their messages
+    # scanned are fetched one by one
+    swept = {}
+    if LODGIFY_CONFIGURATION['bulk_booking_sweep']:
+        bookings = Lodge.get_bookings_sweep(start_date=start_date, end_date=end_date)
+        if isinstance(bookings, list):
+            swept = {booking.booking_id: booking for booking in bookings}
+            bookings = list(swept)
+    else:
+        bookings = Lodge.get_bookings(start_date=start_date, end_date=end_date)
 
     if not isinstance(bookings, list):
         errors.append(bookings)
@@ -144,82 +399,40 @@ def lambda_handler(event, context):
     logging.info("Checking Each Lodgify Booking")
     logging.info("================")
     logging.info("")
-    for entry in bookings:
-        booking = Lodge.get_booking_details(booking_id=entry)
-
-        if "ERROR:" in booking:
-            errors.append(booking)
-            continue
-
-        logging.info("{}, Guest: {}".format(LISTING_MAPPING[booking['property_id']]['display_name'],
-                                            booking['guest']['name']))
-
-        # Skip rentals without remote locks
-        if not LISTING_MAPPING[booking['property_id']]['lock_device_id']:
-            logging.info(f"-- No action, no remote lock for {LISTING_MAPPING[booking['property_id']]['display_name']}")
-            continue
-
-        # Skip any that are not "booked" status, they wouldn't need a door code yet
-        if booking['status'] != "Booked":
-            logging.info("-- No action, reservation not booked (no payment yet?)")
-            results['codes_skipped'].append("*Property:* {}, *Guest:* {} {}-{} (No yet paid?)\n".format(LISTING_MAPPING[booking['property_id']]['display_name'],
-                                                                                                        booking['guest']['name'], booking['arrival'], booking['departure']))
-            continue
-
-        # Check to see if we've previously sent a door code message to this user
-        code_sent = False
-        for message in booking['messages']:
-            if CODE_EMAIL_TEMPLATE[3:25] in message['message']:
-                logging.info("--- Code already sent!")
-                code_sent = True
-                results['codes_skipped'].append("*Property:* {}, *Guest:* {} {}-{} (Already sent)\n".format(LISTING_MAPPING[booking['property_id']]['display_name'],
-                                                                                                            booking['guest']['name'], booking['arrival'], booking['departure']))
-                break
-
-        # Create and send a door code if not already done
-        if not code_sent:
-            logging.info("--- Must create and send a new code.")
-
-            # Get recipient email address
-            recipient_email = Lodge.get_booking_email(booking_id=entry)
-
-            # Throw error if we can't get the email
-            if "ERROR:" in recipient_email:
-                errors.append(recipient_email)
-                continue
-
-            if LIVE:
-                # Create the guest and PIN
-                user_create = locks.create_new_guest(name=booking['guest']['name'],
-                                                     email=booking['guest']['email'],
-                                                     start=booking['arrival'],
-                                                     end=booking['departure'],
-                                                     device_id=LISTING_MAPPING[booking['property_id']]['lock_device_id'])
-
-                # Throw error if we can't create the user on the lock
-                if isinstance(user_create, str):
-                    if "ERROR:" in user_create:
-                        errors.append(user_create)
-                        continue
-
-                # Send the renter the message with the door code
-                message_send = Lodge.send_email_message(
-                    subject="Door code for {}, {}".format(booking['guest']['name'], LISTING_MAPPING[booking['property_id']]['display_name']),
-                    message=CODE_EMAIL_TEMPLATE.format(user_create, RENTAL_CONFIGURATION['check_in_time'],
-                                                       RENTAL_CONFIGURATION['check_out_time']),
-                    recipient=Lodge.get_booking_email(booking_id=entry))
-
-                # Throw error if we can't send the message to the user
-                if isinstance(message_send, str):
-                    if "ERROR:" in message_send:
-                        errors.append(message_send)
-                        continue
-
-                results['codes_sent'].append("*Property:* {}, *Guest:* {} {}-{}\n".format(LISTING_MAPPING[booking['property_id']]['display_name'],
-                                                                                          booking['guest']['name'], booking['arrival'], booking['departure']))
-                logging.info("----- Created code for user, effective {} - {}".format(booking['arrival'], booking['departure']))
+    ledger = CodesLedger()
+    outbox = DoorCodeOutbox(ledger=ledger)
+    if PIPELINE_CONFIGURATION['async']:
+        import asyncio
+        outcomes = asyncio.run(process_bookings_async(bookings, Lodge, locks, outbox, ledger, swept))
+    else:
+        # Only bookings without a code in the ledger need their details from Lodgify
+        to_fetch = [entry for entry in bookings
+                    if not ledger.issued(entry) and (entry not in swept or needs_message_scan(swept[entry]))]
+        all_details = dict(zip(to_fetch, Lodge.get_booking_details_many(booking_ids=to_fetch)))
+        outcomes = []
+        for entry in bookings:
+            if ledger.issued(entry):
+                outcomes.append(already_issued_outcome(ledger.issued(entry)))
             else:
-                logging.info("----- TESTING MODE: Would create and message code to this user.")
+                outcomes.append(process_booking(entry, all_details.get(entry, swept.get(entry)), Lodge, locks, outbox,
+                                                ledger.pending(entry)))
+
+    # Send the door code emails still queued
+    emails_sent = outbox.flush()
+
+    # Outcomes are in booking order, whichever way they were processed
+    for entry, outcome in zip(bookings, outcomes):
+        outcome = settle_outcome(outcome, emails_sent.get(entry))
+        results['codes_sent'].extend(outcome['codes_sent'])
+        results['codes_skipped'].extend(outcome['codes_skipped'])
+        errors.extend(outcome['errors'])
+        if outcome['ledger_entry']:
+            ledger.record(booking_id=entry, **outcome['ledger_entry'])
+
+    ledger.save()
+
+    if locks.pin_allocator:
+        results['pin_space'] = locks.pin_allocator.usage()
 
     # Report all errors, if we have any
     if errors:
@@ -228,9 +441,12 @@ def lambda_handler(event, context):
     # Post to slack
     send_slack_output(results, errors)
 
-    # Do the cleaning updates
-    processor = CleaningNotifier()
-    processor.send_update_cleaning_email()
+    # Save the bookings we fetched, so the cleaning report (cleaning_handler.py) doesn't fetch them again
+    if not LODGIFY_CONFIGURATION['bulk_booking_sweep']:
+        Lodge.booking_cache.save()
+
+    HTTP_CACHE.log_stats()
+    METRICS.emit_emf(run_name="LockAutomation")
 
 
 
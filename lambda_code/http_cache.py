@@ -0,0 +1,186 @@
+"""
+On-disk cache of GET responses for the conditional requests sent by http_session.py.  Responses that carry an ETag or
+Last-Modified validator are saved under /tmp, which a warm Lambda container keeps between invocations.  The next GET
+for the same URL is sent with If-None-Match / If-Modified-Since, and on a 304 the saved body is served instead of
+downloading it again.
+
+The cache is bounded by entry count and total size, evicting the least recently used entries.  It is keyed by URL
+only, as each lambda always calls the APIs with the same credentials.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from config import HTTP_CONFIGURATION
+
+
+class CachedResponse:
+    """
+    A saved response: the validators to revalidate it with, and what is needed to serve it again
+    """
+    __slots__ = ("etag", "last_modified", "content_type", "encoding", "body")
+
+    def __init__(self, etag, last_modified, content_type, encoding, body):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.encoding = encoding
+        self.body = body
+
+
+    def validators(self):
+        """
+        :return: dict of the conditional request headers to send
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class DiskCache:
+
+    def __init__(self, directory, max_entries, max_bytes, enabled=True):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.stored = 0
+        self._index = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".cache")
+
+
+    def _load_index(self):
+        """
+        Builds the LRU index (key -> size, least recently used first) from the files already in the directory, which
+        can outlive this module when it is reloaded
+        """
+        self._index = OrderedDict()
+        self._size = 0
+        if not os.path.isdir(self.directory):
+            return
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".cache"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-len(".cache")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._index[key] = size
+            self._size += size
+
+
+    def get(self, url):
+        """
+        Gets the saved response for a URL
+        :param url: Full URL of the GET request
+        :return: CachedResponse, or None if nothing is saved
+        """
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+
+        try:
+            with open(self._path(key), "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            return None
+
+        return CachedResponse(header['etag'], header['last_modified'], header['content_type'], header['encoding'], body)
+
+
+    def put(self, url, response):
+        """
+        Saves a response, if it has a validator and the server allows storing it
+        :param url: Full URL of the GET request
+        :param response: requests.Response with a 200 status
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not (etag or last_modified) or "no-store" in response.headers.get("Cache-Control", ""):
+            return
+
+        body = response.content
+        header = json.dumps({
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_type": response.headers.get("Content-Type"),
+            "encoding": response.encoding
+        }).encode('utf-8') + b"\n"
+        size = len(header) + len(body)
+        if size > self.max_bytes:
+            return
+
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temp file and rename it in, so a reader never sees half a file
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(body)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logging.info(f"-- Could not cache {url}: {e}")
+            return
+
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            self._size += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self.stored += 1
+            self._evict()
+
+
+    def _evict(self):
+        while self._index and (len(self._index) > self.max_entries or self._size > self.max_bytes):
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+    def serve(self, response, cached):
+        """
+        Turns a 304 response into the saved 200 response
+        :param response: requests.Response with a 304 status
+        :param cached: CachedResponse the request was revalidating
+        """
+        response.status_code = 200
+        response._content = cached.body
+        response._content_consumed = True
+        response.encoding = cached.encoding
+        if cached.content_type:
+            response.headers["Content-Type"] = cached.content_type
+        response.from_cache = True
+        self.hits += 1
+
+
+    def log_stats(self):
+        logging.info(f"HTTP cache: {len(self._index or {})} entries, {self._size / 1024:.1f}KB, {self.hits} served from "
+                     f"cache, {self.stored} saved")
+
+
+HTTP_CACHE = DiskCache(**HTTP_CONFIGURATION['cache'])
@@ -0,0 +1,126 @@
+"""
+Shared HTTP transport for the Lodgify, RemoteLock and Slack integrations.  All calls go through one pooled
+requests.Session, so connections (and their TLS handshakes) are kept alive and reused across calls, and across warm
+Lambda invocations.  requests is only imported when the session is first needed, to keep it out of the Lambda's cold
+start.  Every call is also rate limited and retried per the shared policy in retry.py, and recorded in
+the run's metrics.  GETs are sent as conditional requests when a response for the URL is cached (see http_cache.py).
+"""
+
+import logging
+import time
+import retry
+from metrics import METRICS, describe_url
+from http_cache import HTTP_CACHE
+from config import HTTP_CONFIGURATION, RETRY_CONFIGURATION
+
+_session = None
+
+
+def get_session():
+    """
+    Gets the shared session, creating it on first use with a connection pool mounted for each configured host
+    :return: requests.Session
+    """
+    global _session
+
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        for host, pool_size in HTTP_CONFIGURATION['pool_sizes'].items():
+            session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        _session = session
+
+    return _session
+
+
+def request(method, url, **kwargs):
+    """
+    Sends a request over the shared session, applying the configured timeout unless one is given.  Rate limited and
+    transient failures (429/5xx, connection errors) are retried with backoff while the run's retry budget lasts.  Other
+    methods are only retried on 429/503, or a timeout connecting, where the server never acted on the request.
+    :param method: HTTP method
+    :param url: Full URL to call
+    :param kwargs: Any other arguments accepted by requests
+    :return: requests.Response
+    """
+    kwargs.setdefault("timeout", HTTP_CONFIGURATION['timeout'])
+
+    # Streamed bodies are consumed by the caller, so only plain GETs are cached
+    cacheable = method == "GET" and HTTP_CACHE.enabled and not kwargs.get("stream")
+    cached = HTTP_CACHE.get(url) if cacheable else None
+    if cached is not None:
+        kwargs["headers"] = dict(kwargs.get("headers") or {}, **cached.validators())
+
+    started = time.perf_counter()
+    response = None
+    try:
+        response = _request_with_retries(method, url, kwargs)
+        if cached is not None and response.status_code == 304:
+            HTTP_CACHE.serve(response, cached)
+        elif cacheable and response.status_code == 200:
+            HTTP_CACHE.put(url, response)
+        return response
+    finally:
+        sent = received = retries = 0
+        if response is not None:
+            sent = len(response.request.body or b"")
+            retries = response.retries
+            # Don't read a streamed body here, the caller is still consuming it, and a body served from the cache
+            # wasn't downloaded
+            if kwargs.get("stream"):
+                received = int(response.headers.get("Content-Length") or 0)
+            elif not getattr(response, "from_cache", False):
+                received = len(response.content or b"")
+        api, endpoint = describe_url(method, url)
+        METRICS.record(api, endpoint, time.perf_counter() - started, bytes_sent=sent, bytes_received=received,
+                       retries=retries)
+
+
+def _request_with_retries(method, url, kwargs):
+    """
+    Sends a request, retrying per the shared retry policy
+    :return: requests.Response, with the number of retries it took set as response.retries
+    """
+    from requests import ConnectionError, ConnectTimeout, Timeout
+
+    limiter = retry.get_rate_limiter(url)
+    attempt = 0
+
+    while True:
+        if limiter:
+            limiter.acquire()
+
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except (ConnectionError, Timeout) as e:
+            # A write may have reached the server before the error, so it is only sent again if the connection was
+            # never made
+            if method.upper() != "GET" and not isinstance(e, ConnectTimeout):
+                raise
+            if attempt + 1 >= RETRY_CONFIGURATION['max_attempts'] or not retry.RETRY_BUDGET.consume():
+                raise
+            delay = retry.backoff_delay(attempt)
+            logging.info(f"-- {method} {url} failed with {e}, retrying in {delay:.1f}s")
+        else:
+            response.retries = attempt
+            if not retry.is_retryable(method, response.status_code):
+                return response
+            if attempt + 1 >= RETRY_CONFIGURATION['max_attempts'] or not retry.RETRY_BUDGET.consume():
+                return response
+            delay = retry.backoff_delay(attempt, retry_after=response.headers.get("Retry-After"))
+            logging.info(f"-- {method} {url} got {response.status_code}, retrying in {delay:.1f}s")
+            # Hand the connection back to the pool, a streamed body would otherwise hold it open
+            response.close()
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
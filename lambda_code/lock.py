@@ -1,28 +1,40 @@
-import requests
+import http_session
 import json
-import random
 import os
 import logging
-from config import *
+import threading
+import time
+from pin_allocator import PinAllocator
+from config import GLOBAL_LOCK_CONFIGURATION, RENTAL_CONFIGURATION
+
+
+# The oauth token is kept at module level, so warm Lambda invocations reuse it until it is about to expire
+TOKEN_CACHE = {
+    "access_token": None,
+    "expires_at": 0
+}
+TOKEN_REFRESH_MARGIN_SECONDS = 60
+_token_lock = threading.Lock()
+
+
+class RemoteLockError(Exception):
+    pass
 
 
 class Lock:
 
+    host = "https://connect.remotelock.com/"
+    api_host = "https://api.remotelock.com/"
+
     def __init__(self):
-        self.host = "https://connect.remotelock.com/"
-        self.api_host = "https://api.remotelock.com/"
-        self.token = self.get_token()
-        self.headers = {
-            "Accept": "application/json",
-            "Content-type": "application/json",
-            "Authorization": "Bearer {}".format(self.token)
-        }
+        self.pin_allocator = None
+        self._pin_allocator_lock = threading.Lock()
 
 
     def get_token(self):
         """
-        Gets an oauth token using the client ID and secret
-        :return:
+        Gets an oauth token using the client ID and secret, and caches it along with its expiry time
+        :return: The access token, or False if RemoteLock did not give us one
         """
         url = "oauth/token"
         headers = {
@@ -34,67 +46,161 @@ class Lock:
             "client_secret": os.getenv("LOCK_SECRET"),
             "grant_type": "client_credentials"
         }
-        response = requests.post(self.host + url, headers=headers, params=params)
+        response = http_session.post(self.host + url, headers=headers, params=params)
         if response.status_code != 200:
+            logging.error("ERROR! Could not get RemoteLock token, got status code: {}".format(response.status_code))
             return False
 
         details = json.loads(response.text)
+        TOKEN_CACHE['access_token'] = details['access_token']
+        TOKEN_CACHE['expires_at'] = time.time() + details.get('expires_in', 0)
         return details['access_token']
 
 
-    def send_post_request(self, url, params):
-        response = requests.post(self.api_host + url, headers=self.headers, json=params)
-        if response.status_code not in [200, 201]:
+    def get_cached_token(self, force_refresh=False):
+        """
+        Gets the cached oauth token, fetching a new one if there is none, or it is about to expire
+        :param force_refresh: Set to True to ignore the cached token (e.g. after a 401)
+        :return: The access token, or False if RemoteLock did not give us one
+        """
+        with _token_lock:
+            if not force_refresh and TOKEN_CACHE['access_token'] and \
+                    time.time() < TOKEN_CACHE['expires_at'] - TOKEN_REFRESH_MARGIN_SECONDS:
+                return TOKEN_CACHE['access_token']
+
+            TOKEN_CACHE['access_token'] = None
+            return self.get_token()
+
+
+    def send_request(self, method, url, params=None, ok_statuses=(200,)):
+        """
+        Sends a request to the RemoteLock API with the cached token, refreshing the token and retrying once if it was
+        rejected
+        :param method: HTTP method
+        :param url: API endpoint (e.g. "access_persons"), or a full URL
+        :param params: JSON body to send, if any
+        :param ok_statuses: Status codes that count as success
+        :return: dict of the JSON response
+        :raises RemoteLockError: If the request failed, including connection errors and timeouts once retries ran out
+        """
+        from requests import RequestException
+
+        # Paging links from RemoteLock are full URLs
+        if not url.startswith("http"):
+            url = self.api_host + url
+
+        force_refresh = False
+        for attempt in range(2):
+            try:
+                token = self.get_cached_token(force_refresh=force_refresh)
+                if not token:
+                    raise RemoteLockError("No RemoteLock token, can't call {}".format(url))
+
+                headers = {
+                    "Accept": "application/json",
+                    "Content-type": "application/json",
+                    "Authorization": "Bearer {}".format(token)
+                }
+                response = http_session.request(method, url, headers=headers, json=params)
+            except RequestException as e:
+                raise RemoteLockError("Could not reach RemoteLock for {}: {}".format(url, e)) from e
+            if response.status_code != 401:
+                break
+            logging.info("-- RemoteLock token rejected, refreshing it")
+            force_refresh = True
+
+        if response.status_code not in ok_statuses:
             logging.error("ERROR! Got status code: {}".format(response.status_code))
             logging.error(response.text)
-            exit()
+            raise RemoteLockError("Got status code {} from {}".format(response.status_code, url))
 
         details = json.loads(response.text)
         return details
 
+
+    def send_post_request(self, url, params):
+        return self.send_request("POST", url, params=params, ok_statuses=(200, 201))
+
+
     def send_get_request(self, url):
-        response = requests.get(self.api_host + url, headers=self.headers)
-        if response.status_code != 200:
-            logging.error("ERROR! Got status code: {}".format(response.status_code))
-            logging.error(response.text)
-            exit()
+        return self.send_request("GET", url)
 
-        details = json.loads(response.text)
-        return details
+
+    def iter_collection(self, url, per_page=100):
+        """
+        Lazily yields every record of a RemoteLock collection endpoint, following the paging links (or the page
+        count in the meta block) one page at a time.  Callers can stop early once they find what they need.
+        :param url: Collection endpoint, ex: "access_persons"
+        :param per_page: Number of records to request per page
+        :return: generator of records
+        """
+        separator = "&" if "?" in url else "?"
+        next_url = "{}{}page=1&per_page={}".format(url, separator, per_page)
+        page = 1
+
+        while next_url:
+            response = self.send_get_request(url=next_url)
+            for record in response.get('data', []):
+                yield record
+
+            links = response.get('links') or {}
+            total_pages = (response.get('meta') or {}).get('total_pages', 1)
+            page += 1
+            if links.get('next'):
+                next_url = links['next']
+            elif page <= total_pages:
+                next_url = "{}{}page={}&per_page={}".format(url, separator, page, per_page)
+            else:
+                next_url = None
 
 
     def get_locations(self):
-        return self.send_get_request(url="devices")
+        return {"data": list(self.iter_collection(url="devices"))}
 
 
     def get_schedules(self):
-        return self.send_get_request(url="schedules")
+        return {"data": list(self.iter_collection(url="schedules"))}
 
 
     def get_devices(self):
-        return self.send_get_request(url="devices")
+        return {"data": list(self.iter_collection(url="devices"))}
 
 
     def get_device_id_for_unit(self, unit=None):
-        devices = self.get_devices()
-        for device in devices['data']:
+        for device in self.iter_collection(url="devices"):
             if unit in device['attributes']['name']:
                 return device['id']
 
 
+    def get_existing_pins(self):
+        """
+        Gets the PINs of all access persons on the account, across all pages
+        :return: generator of PINs
+        """
+        for entry in self.iter_collection(url="access_persons"):
+            yield entry['attributes'].get('pin')
+
+
+    def load_pin_allocator(self):
+        """
+        Builds the PIN index from the account's existing PINs.  This is done once per run, on the first new guest.
+        """
+        self.pin_allocator = PinAllocator(start=GLOBAL_LOCK_CONFIGURATION['random_pin_start'],
+                                          end=GLOBAL_LOCK_CONFIGURATION['random_pin_end'],
+                                          used_pins=self.get_existing_pins())
+        logging.info(f"-- Loaded existing pins, {self.pin_allocator.usage()}")
+
+
     def create_pin(self):
         logging.info("- Creating PIN")
-        existing_pins = {}
-        existing_users = self.send_get_request(url="access_persons")
-        for entry in existing_users['data']:
-            existing_pins[entry['attributes']['pin']] = entry['attributes']['name']
-        logging.info(f"-- Got {len(existing_pins)} existing pins")
+        with self._pin_allocator_lock:
+            if self.pin_allocator is None:
+                self.load_pin_allocator()
 
-        while True:
-            new_pin = random.randint(GLOBAL_LOCK_CONFIGURATION['random_pin_start'],GLOBAL_LOCK_CONFIGURATION['random_pin_end'])
-            if new_pin not in existing_pins:
-                logging.info(f"--- using random pin of {new_pin}")
-                return new_pin
+        new_pin = self.pin_allocator.allocate()
+        if new_pin is not None:
+            logging.info(f"--- using random pin of {new_pin}")
+        return new_pin
 
 
     def grant_user_access(self, device_id, guest_id):
@@ -132,9 +238,8 @@ class Lock:
         try:
             response = self.send_post_request(url="access_persons",
                                               params=params)
-            self.lock_pin = response['data']['attributes']['pin']
-            logging.info(f"------ Remotelock reports a PIN of {self.lock_pin}")
-            return response['data']['id']
+            logging.info(f"------ Remotelock reports a PIN of {response['data']['attributes']['pin']}")
+            return response['data']
         except Exception as e:
             return "ERROR: Could not create new guest {}! Got error: {}".format(name, e)
 
@@ -143,19 +248,28 @@ class Lock:
     def create_new_guest(self, name, email, start, end, device_id, pin=None):
 
         if not pin:
-            pin = self.create_pin()
+            try:
+                pin = self.create_pin()
+            except RemoteLockError as e:
+                return "ERROR: Could not create a PIN for guest {}! Got error: {}".format(name, e)
+
+        if not pin:
+            return "ERROR: Could not create a PIN for guest {}, all PINs are in use! {}".format(name, self.pin_allocator.usage())
 
-        new_guest_id = self.create_new_user(name=name, email=email, start=start, end=end, pin=pin)
+        new_guest = self.create_new_user(name=name, email=email, start=start, end=end, pin=pin)
 
-        if "ERROR" in new_guest_id:
-            return new_guest_id
+        if isinstance(new_guest, str):
+            return new_guest
 
-        access = self.grant_user_access(device_id=device_id, guest_id=new_guest_id)
+        access = self.grant_user_access(device_id=device_id, guest_id=new_guest['id'])
 
         if "ERROR" in access:
             return access
 
-        return self.lock_pin
+        return {
+            "guest_id": new_guest['id'],
+            "pin": new_guest['attributes']['pin']
+        }
 
 
 if __name__ == "__main__":
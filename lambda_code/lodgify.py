@@ -1,72 +1,50 @@
-import requests
+import http_session
 import json
 import os
 import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from utils import validate_date_input
-import boto3
-from config import *
+from booking_cache import BookingCache
+from booking_record import BookingRecord
+from config import LISTING_MAPPING, LODGIFY_CONFIGURATION
 
 
 class Lodgify:
 
-    def __init__(self):
+    api_host = "https://api.lodgify.com/"
+
+    def __init__(self, booking_cache=None):
         self.HEADERS = {
             "Accept": "text/plain",
             "X-ApiKey": os.getenv("LODGIFY_API_KEY"),
             "Content-Type": "application/*+json"
         }
+        self.booking_cache = booking_cache if booking_cache is not None else BookingCache()
+
+        # Thread UIDs seen in a bulk sweep, so get_booking_email doesn't need to fetch them again
+        self.thread_uids = {}
 
 
-    def get_booking_details(self, booking_id=None):
+    def get_booking_details(self, booking_id=None, use_cache=True):
         """
-        Gets the details for a booking
+        Gets the details for a booking.  Details already fetched during this run are served from the booking cache.
         :param booking_id: The booking to get details for
-        :return: a dict of booking details, ex:
+        :param use_cache: Set to False to always fetch fresh details from Lodgify
+        :return: BookingRecord, parsed from the booking details, ex:
 
             {
                "id": <BOOKING ID>,
-               "type": "Booking",
-               "booking_type": "InstantBooking",
                "status": "Booked",
-               "source": "Manual",
-               "source_text": "Direct",
                "guest": {
-                  "id": "<GUEST ID>",
-                  "country_name": null,
                   "name": "Mark B",
                   "email": null,
                    ...
-                  "state": null
                },
                "arrival": "2022-05-27",
                "departure": "2022-05-29",
-               "people": 2,
                "property_id": <PROPERTY ID>,
-               "property_name": "<PROPERTY NAME>",
-               "rooms": [
-                  {
-                     "name": "<PROPERTY NAME>",
-                     "room_type_id": 448939,
-                     "people": 2,
-                     "key_code": null
-                  }
-               ],
-               "created_at": "2022-04-25T12:49:48",
-               "is_replied": true,
                "updated_at": "2022-04-25T12:49:48",
-               "is_deleted": false,
-               "date_deleted": null,
-               "total_amount": 0.0,
-               "total_paid": 0.0,
-               "amount_to_pay": 0.0,
-               "currency": {
-                  "id": 50,
-                  "code": "USD",
-                  "name": "US dollar",
-                  "euro_forex": 1.0577,
-                  "symbol": "$  "
-               },
-               "note": null,
                "messages": [
                   {
                      "subject": "<MESSAGE SUBJECT>",
@@ -77,33 +55,61 @@ class Lodgify:
                   },
                   ...
                ],
-               "payment_type": null,
-               "payment_address": null,
-               "payment_website_id": null
+               ...
             }
+
+            The rest of the payload (rooms, currency, payment details, etc.) isn't kept, and the messages are only
+            checked for a door code that has already been sent.
         """
-        url = "https://api.lodgify.com/v1/reservation/booking/{}".format(booking_id)
-        try:
-            response = requests.request("GET", url, headers=self.HEADERS)
-            details = json.loads(response.text)
+        if use_cache:
+            cached = self.booking_cache.get(booking_id)
+            if cached is not None:
+                return cached
 
+        url = "{}v1/reservation/booking/{}".format(self.api_host, booking_id)
+        try:
+            response = http_session.request("GET", url, headers=self.HEADERS)
             if response.status_code != 200:
                 return "ERROR: Failed to get booking details for booking: {}.  Got status code: {}".format(booking_id, response.status_code)
-            return details
+
+            booking = BookingRecord.from_v1(json.loads(response.text))
+            self.booking_cache.put(booking_id, booking)
+            return booking
 
         except Exception as e:
             return "ERROR: Could not get booking details for {}, got exception error: {}".format(booking_id, e)
 
 
+    def get_booking_details_many(self, booking_ids=None, max_workers=None):
+        """
+        Gets the details for many bookings at once, fetching them concurrently
+        :param booking_ids: List of bookings to get details for
+        :param max_workers: Max number of concurrent requests to Lodgify (defaults to the configured limit)
+        :return: a list of BookingRecord (or "ERROR: ..." strings), in the same order as booking_ids
+        """
+        booking_ids = list(booking_ids or [])
+        if not booking_ids:
+            return []
+
+        if not max_workers:
+            max_workers = LODGIFY_CONFIGURATION['max_concurrent_requests']
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(booking_ids))) as executor:
+            return list(executor.map(lambda booking_id: self.get_booking_details(booking_id=booking_id), booking_ids))
+
+
     def get_booking_email(self, booking_id=None):
         """
         Gets the email address of the user associated with the provided booking ID
         :param booking_id: The Booking ID to get the email for
         :return: The lodgify email address of the user
         """
-        url = "https://api.lodgify.com/v2/reservations/bookings/{}".format(booking_id)
+        if self.thread_uids.get(str(booking_id)):
+            return "renter-{}@lodgify.com".format(self.thread_uids[str(booking_id)])
+
+        url = "{}v2/reservations/bookings/{}".format(self.api_host, booking_id)
         try:
-            response = requests.request("GET", url, headers=self.HEADERS)
+            response = http_session.request("GET", url, headers=self.HEADERS)
             details = json.loads(response.text)
 
             if response.status_code != 200:
@@ -122,48 +128,173 @@ class Lodgify:
         :param end_date: End date to find bookings (format: MM-DD-YYYY)
         :return: A list of booking IDs
         """
+        blocks = self.get_booking_blocks(start_date=start_date, end_date=end_date)
+        if not isinstance(blocks, list):
+            return blocks
+
+        return [block['booking_id'] for block in blocks]
+
+
+    def get_bookings_sweep(self, start_date='01-01-2022', end_date='12-31-2022'):
+        """
+        Gets the bookings for the configured properties that overlap the date range, along with their details, in one
+        paged sweep of the v2 bookings list.  This replaces the availability call and the detail and email calls for
+        each booking, except for the message history, which only the v1 booking details include.
+        :param start_date: Start date to find bookings (format: MM-DD-YYYY)
+        :param end_date: End date to find bookings (format: MM-DD-YYYY)
+        :return: A list of BookingRecord.  The v2 list has no messages, so code_sent is None for each.
+        """
+
+        if not validate_date_input(dates=[start_date, end_date]):
+            logging.error("WRONG DATES")
+            return False
+
+        start = datetime.strptime(start_date, "%m-%d-%Y").strftime("%Y-%m-%d")
+        end = datetime.strptime(end_date, "%m-%d-%Y").strftime("%Y-%m-%d")
+        page_size = LODGIFY_CONFIGURATION['sweep_page_size']
+        bookings = []
+        page = 1
+
+        while True:
+            # Everything departing from the start date on, the end of the window is filtered below
+            url = "{}v2/reservations/bookings?page={}&size={}&includeCount=true&stayFilter=DepartureDate" \
+                  "&stayFilterDate={}T00:00:00".format(self.api_host, page, page_size, start)
+            try:
+                response = http_session.request("GET", url, headers=self.HEADERS)
+
+                if response.status_code != 200:
+                    return "ERROR: Failed to get bookings, got {} from Lodgify API".format(response.status_code)
+
+                details = json.loads(response.text)
+            except Exception as e:
+                return "ERROR: Could not get bookings, got exception error: {}".format(e)
+
+            for item in details['items']:
+
+                # Only bookings that hold the dates, the same as the availability calendar shows
+                if item['status'] not in ["Booked", "Tentative"] or item.get('is_deleted'):
+                    continue
+
+                # Don't include any properties that are not in our config
+                if item['property_id'] not in LISTING_MAPPING:
+                    continue
+
+                if item['arrival'][:10] > end or item['departure'][:10] < start:
+                    continue
+
+                logging.info("{} is booked from {} to {}, ID {}".format(LISTING_MAPPING[item['property_id']]['display_name'],
+                                                                        item['arrival'],
+                                                                        item['departure'],
+                                                                        item['id']))
+                booking = BookingRecord.from_v2(item)
+                if booking.thread_uid:
+                    self.thread_uids[str(booking.booking_id)] = booking.thread_uid
+                bookings.append(booking)
+
+            # Stop on a short page, or once the count says there are no more
+            if len(details['items']) < page_size or page * page_size >= details.get('count', float('inf')):
+                break
+            page += 1
+
+        logging.info(f"Bulk sweep: {len(bookings)} bookings in {page} pages")
+        return bookings
+
+
+    def get_booking_blocks(self, start_date='01-01-2022', end_date='12-31-2022'):
+        """
+        Gets the booked blocks from the availability calendar for the configured properties, during the date range
+        specified
+        :param start_date: Start date to find bookings (format: MM-DD-YYYY)
+        :param end_date: End date to find bookings (format: MM-DD-YYYY)
+        :return: A list of booked blocks, ex:
+
+            [
+                {
+                    "booking_id": <BOOKING ID>,
+                    "property_id": <PROPERTY ID>,
+                    "period_start": "2022-05-27T00:00:00",
+                    "period_end": "2022-05-29T00:00:00"
+                },
+                ...
+            ]
+        """
 
         if not validate_date_input(dates=[start_date, end_date]):
             logging.error("WRONG DATES")
             return False
 
         bookings = []
-        url = "https://api.lodgify.com/v1/availability?BookingsOnly=true&IncludeBookingIds=true&periodStart={}&periodEnd={}".format(start_date,
-                                                                                                                                    end_date)
+        url = "{}v1/availability?BookingsOnly=true&IncludeBookingIds=true&periodStart={}&periodEnd={}".format(self.api_host,
+                                                                                                               start_date,
+                                                                                                               end_date)
+        stream = LODGIFY_CONFIGURATION['stream_availability']
         try:
-            response = requests.request("GET", url, headers=self.HEADERS)
-            details = json.loads(response.text)
+            response = http_session.request("GET", url, headers=self.HEADERS, stream=stream)
+        except Exception as e:
+            return "ERROR: Could not get bookings, got exception error: {}".format(e)
 
+        with response:
             if response.status_code != 200:
                 return "ERROR: Failed to get bookings, got {} from Lodgify API".format(response.status_code)
-        except Exception as e:
-            return "ERROR: Could not get bookings, got exception error: {}".format(e)
 
-        for entry in details:
+            try:
+                # Each entry is filtered as soon as it is parsed, so only the booked blocks are kept in memory
+                for entry in self._iter_availability(response, stream=stream):
+
+                    # Don't include bookings where the dates are marked "available" for some reason?
+                    if entry['is_available']:
+                        logging.info(" -- skipping, marked as available")
+                        continue
 
-            # Don't include bookings where the dates are marked "available" for some reason?
-            if entry['is_available']:
-                logging.info(" -- skipping, marked as available")
-                continue
+                    # Don't include any blocks that don't have associated booking IDs
+                    if not entry['booking_ids']:
+                        logging.info(" -- skipping, no booking IDs")
+                        continue
 
-            # Don't include any blocks that don't have associated booking IDs
-            if not entry['booking_ids']:
-                logging.info(" -- skipping, no booking IDs")
-                continue
+                    # Don't include any properties that are not in our config
+                    if entry['property_id'] not in LISTING_MAPPING:
+                        logging.info(" -- skipping, not a tracked property")
+                        continue
 
-            # Don't include any properties that are not in our config
-            if entry['property_id'] not in LISTING_MAPPING:
-                logging.info(" -- skipping, not a tracked property")
-                continue
+                    logging.info("{} is booked from {} to {}, ID {}".format(LISTING_MAPPING[entry['property_id']]['display_name'],
+                                                                            entry['period_start'],
+                                                                            entry['period_end'],
+                                                                            entry['booking_ids'][0]))
+                    bookings.append({
+                        "booking_id": entry['booking_ids'][0],
+                        "property_id": entry['property_id'],
+                        "period_start": entry['period_start'],
+                        "period_end": entry['period_end']
+                    })
+            except Exception as e:
+                return "ERROR: Could not get bookings, got exception error: {}".format(e)
 
-            logging.info("{} is booked from {} to {}, ID {}".format(LISTING_MAPPING[entry['property_id']]['display_name'],
-                                                                    entry['period_start'],
-                                                                    entry['period_end'],
-                                                                    entry['booking_ids'][0]))
-            bookings.append(entry['booking_ids'][0])
         return bookings
 
 
+    @staticmethod
+    def _iter_availability(response, stream=False):
+        """
+        Yields the entries of an availability response.  If the response was streamed and ijson is installed, entries
+        are parsed as the body downloads, otherwise the whole body is parsed at once.
+        :param response: requests.Response from the availability endpoint
+        :param stream: True if the request was made with stream=True
+        :return: generator of availability entry dicts
+        """
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+
+        if not stream or ijson is None:
+            yield from json.loads(response.text)
+            return
+
+        # Let urllib3 undo any gzip encoding, as requests would
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, 'item', use_float=True)
+
+
     def add_message(self, booking_id=None, subject=None, message=None):
         """
         Adds a message to a booking
@@ -171,46 +302,7 @@ class Lodgify:
         :param subject: Subject of message to send
         :param message: HTML message body to send
         """
-        url = "https://api.lodgify.com/v1/reservation/booking/{}/messages".format(booking_id)
+        url = "{}v1/reservation/booking/{}/messages".format(self.api_host, booking_id)
         payload = "[{\"subject\":\"" + subject + "\",\"message\":\"" + message + "\",\"type\":\"Owner\"}]"
-        response = requests.request("POST", url, data=payload, headers=self.HEADERS)
+        response = http_session.request("POST", url, data=payload, headers=self.HEADERS)
         logging.info(response.text)
-
-
-    def send_email_message(self, subject=None, message=None, recipient=None):
-        """
-        Sends an email message
-        :param subject: Email subject
-        :param message: Email message body
-        :param recipient: Email recipient
-        :return:
-        """
-        try:
-            client = boto3.client('ses', region_name=AWS_CONFIGURATION['region'])
-            res = client.send_email(
-                Source=EMAIL_CONFIGURATION['from_address'],
-                Destination={
-                    "ToAddresses": [recipient],
-                    "BccAddresses": EMAIL_CONFIGURATION['bcc_addresses']
-                },
-                Message={
-                    'Body': {
-                        'Html': {
-                            'Charset': 'UTF-8',
-                            'Data': message,
-                        },
-                        'Text': {
-                            'Charset': 'UTF-8',
-                            'Data': message,
-                        },
-                    },
-                    'Subject': {
-                        'Charset': 'UTF-8',
-                        'Data': subject,
-                    },
-                }
-            )
-            return True
-
-        except Exception as e:
-            return "ERROR: Could not send email to user: {} Got error: {}".format(recipient, e)
@@ -0,0 +1,155 @@
+"""
+Per-endpoint instrumentation of outbound calls: counts, p50/p95 latency, bytes transferred and retries for every call
+to Lodgify, RemoteLock, Slack (recorded in http_session.py) and SES/S3 (recorded through botocore events in
+aws_clients.py).  At the end of a run the numbers are written as CloudWatch Embedded Metric Format log lines, and
+summarised in the Slack report.
+"""
+
+import json
+import math
+import re
+import threading
+import time
+from urllib.parse import urlparse
+from config import AWS_CONFIGURATION
+
+API_NAMES = {
+    "api.lodgify.com": "Lodgify",
+    "api.remotelock.com": "RemoteLock",
+    "connect.remotelock.com": "RemoteLock",
+    "hooks.slack.com": "Slack"
+}
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile
+    :param values: Sorted list of numbers
+    :param fraction: Percentile to get, ex: 0.95
+    """
+    if not values:
+        return 0
+    index = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+def describe_url(method, url):
+    """
+    Names the API and endpoint a URL belongs to, with IDs replaced so calls for different bookings group together
+    :return: (api, endpoint), ex: ("Lodgify", "GET /v1/reservation/booking/{id}")
+    """
+    parsed = urlparse(url)
+    api = API_NAMES.get(parsed.netloc, parsed.netloc)
+    path = re.sub(r"/(\d+|[0-9a-f]{8}-[0-9a-f-]{27,})(?=/|$)", "/{id}", parsed.path)
+    if api == "Slack":
+        path = "/webhook"
+    return api, f"{method.upper()} {path}"
+
+
+class ApiMetrics:
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, api, endpoint, latency, bytes_sent=0, bytes_received=0, retries=0):
+        """
+        Records one call
+        :param api: API name, ex: "Lodgify"
+        :param endpoint: Endpoint name, ex: "GET /v1/availability"
+        :param latency: Seconds the call took, including any retries
+        :param bytes_sent: Size of the request body
+        :param bytes_received: Size of the response body
+        :param retries: Number of retries the call needed
+        """
+        with self._lock:
+            stats = self.endpoints.setdefault((api, endpoint), {
+                "latencies": [],
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "retries": 0
+            })
+            stats['latencies'].append(latency)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['retries'] += retries
+
+
+    def summary(self):
+        """
+        :return: list of dicts, one per endpoint, sorted by API and endpoint
+        """
+        with self._lock:
+            rows = []
+            for (api, endpoint), stats in sorted(self.endpoints.items()):
+                latencies = sorted(stats['latencies'])
+                rows.append({
+                    "api": api,
+                    "endpoint": endpoint,
+                    "calls": len(latencies),
+                    "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "total_ms": round(sum(latencies) * 1000, 1),
+                    "bytes_sent": stats['bytes_sent'],
+                    "bytes_received": stats['bytes_received'],
+                    "retries": stats['retries']
+                })
+            return rows
+
+
+    def emit_emf(self, run_name):
+        """
+        Prints one CloudWatch Embedded Metric Format line per endpoint.  Lambda sends stdout to CloudWatch Logs,
+        which turns these lines into metrics.
+        :param run_name: Which automation ran, added as a dimension, ex: "LockAutomation"
+        """
+        timestamp = int(time.time() * 1000)
+        for row in self.summary():
+            print(json.dumps({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": AWS_CONFIGURATION['metrics_namespace'],
+                        "Dimensions": [["Run", "Api", "Endpoint"], ["Run", "Api"]],
+                        "Metrics": [
+                            {"Name": "Calls", "Unit": "Count"},
+                            {"Name": "LatencyP50", "Unit": "Milliseconds"},
+                            {"Name": "LatencyP95", "Unit": "Milliseconds"},
+                            {"Name": "BytesSent", "Unit": "Bytes"},
+                            {"Name": "BytesReceived", "Unit": "Bytes"},
+                            {"Name": "Retries", "Unit": "Count"}
+                        ]
+                    }]
+                },
+                "Run": run_name,
+                "Api": row['api'],
+                "Endpoint": row['endpoint'],
+                "Calls": row['calls'],
+                "LatencyP50": row['p50_ms'],
+                "LatencyP95": row['p95_ms'],
+                "BytesSent": row['bytes_sent'],
+                "BytesReceived": row['bytes_received'],
+                "Retries": row['retries']
+            }))
+
+
+    def slack_text(self):
+        """
+        :return: markdown summary of the calls made, one line per endpoint
+        """
+        lines = []
+        for row in self.summary():
+            lines.append("`{} {}`: {} calls, p50 {}ms, p95 {}ms, {:.1f}KB, {} retries\n".format(
+                row['api'], row['endpoint'], row['calls'], row['p50_ms'], row['p95_ms'],
+                (row['bytes_sent'] + row['bytes_received']) / 1024, row['retries']))
+        return "".join(lines)
+
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+
+# Shared by every client in the run.  Warm invocations keep it, so handlers reset it at the start of each run.
+METRICS = ApiMetrics()
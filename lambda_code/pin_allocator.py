@@ -0,0 +1,75 @@
+import random
+import threading
+
+# Random picks to try before falling back to scanning for the next free PIN
+MAX_RANDOM_TRIES = 20
+
+
+class PinAllocator:
+    """
+    Index of the PINs in use on the RemoteLock account, over the configured random PIN range.  It is loaded once per
+    run, then hands out free PINs in O(1) (on average) and marks them as used as they are issued.
+    """
+
+    def __init__(self, start, end, used_pins=()):
+        self.start = start
+        self.end = end
+        self.size = end - start + 1
+        self.used = bytearray(self.size)
+        self.used_count = 0
+        self._lock = threading.Lock()
+
+        for pin in used_pins:
+            self.mark_used(pin)
+
+
+    def mark_used(self, pin):
+        """
+        Marks a PIN as taken.  PINs outside the range (or not numeric) can't collide with ours, so are ignored.
+        :param pin: PIN to mark, as an int or string
+        """
+        try:
+            pin = int(pin)
+        except (TypeError, ValueError):
+            return
+
+        if not self.start <= pin <= self.end:
+            return
+
+        index = pin - self.start
+        if not self.used[index]:
+            self.used[index] = 1
+            self.used_count += 1
+
+
+    def allocate(self):
+        """
+        Picks a random free PIN and marks it as used
+        :return: The new PIN, or None if every PIN in the range is taken
+        """
+        with self._lock:
+            if self.used_count >= self.size:
+                return None
+
+            for _ in range(MAX_RANDOM_TRIES):
+                index = random.randrange(self.size)
+                if not self.used[index]:
+                    break
+            else:
+                # The range is crowded, so take the next free PIN after a random spot instead
+                offset = random.randrange(self.size)
+                index = self.used.find(0, offset)
+                if index == -1:
+                    index = self.used.find(0, 0, offset)
+
+            pin = self.start + index
+            self.mark_used(pin)
+            return pin
+
+
+    def usage(self):
+        """
+        Reports how full the PIN range is
+        :return: string, ex: "152 of 90000 PINs in use (0.2%)"
+        """
+        return "{} of {} PINs in use ({:.1f}%)".format(self.used_count, self.size, 100.0 * self.used_count / self.size)
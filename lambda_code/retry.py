@@ -0,0 +1,140 @@
+"""
+Shared retry policy for outbound API calls: exponential backoff with full jitter, honouring Retry-After, a token
+bucket rate limiter per API host, and a cap on the number of retries per run so a real outage fails fast instead of
+retrying every call.
+"""
+
+import email.utils
+import random
+import threading
+import time
+from config import RETRY_CONFIGURATION
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Statuses where the server did not act on the request, so even a POST is safe to send again
+RETRYABLE_STATUSES_FOR_WRITES = (429, 503)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.  Each call takes a token, and tokens refill at a fixed rate up to the burst size.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until one is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class RetryBudget:
+    """
+    Number of retries allowed across all calls in one run
+    """
+
+    def __init__(self, retries):
+        self.retries = retries
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+
+    def consume(self):
+        """
+        Takes one retry from the budget
+        :return: True if a retry is allowed, False if the budget is spent
+        """
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+    def reset(self):
+        with self._lock:
+            self.remaining = self.retries
+
+
+RETRY_BUDGET = RetryBudget(RETRY_CONFIGURATION['run_budget'])
+RATE_LIMITERS = {host: TokenBucket(rate=limit['rate'], burst=limit['burst'])
+                 for host, limit in RETRY_CONFIGURATION['rate_limits'].items()}
+
+
+def get_rate_limiter(url):
+    """
+    Gets the rate limiter for the API a URL belongs to
+    :param url: Full URL being called
+    :return: TokenBucket, or None if the host is not rate limited
+    """
+    for host, limiter in RATE_LIMITERS.items():
+        if url.startswith(host):
+            return limiter
+    return None
+
+
+def is_retryable(method, status_code):
+    """
+    Checks if a response status is worth retrying for the given method
+    :param method: HTTP method of the request
+    :param status_code: Status code of the response
+    :return: True or False
+    """
+    if method.upper() == "GET":
+        return status_code in RETRYABLE_STATUSES
+    return status_code in RETRYABLE_STATUSES_FOR_WRITES
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, which is either a number of seconds or an HTTP date
+    :param value: Header value
+    :return: Seconds to wait, or None if there is no usable value
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Works out how long to wait before the next attempt
+    :param attempt: Number of the attempt that just failed, starting at 0
+    :param retry_after: Retry-After header value from the response, if any
+    :return: Seconds to wait
+    """
+    delay = parse_retry_after(retry_after)
+    if delay is not None:
+        return min(delay, RETRY_CONFIGURATION['max_delay'])
+
+    ceiling = min(RETRY_CONFIGURATION['max_delay'], RETRY_CONFIGURATION['base_delay'] * (2 ** attempt))
+    return random.uniform(0, ceiling)
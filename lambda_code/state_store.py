@@ -0,0 +1,216 @@
+"""
+Storage for the cleaning automation's booking state (what was previously a single rentals.json).  The state is split
+per unit into gzip'd JSON lines files, and a small manifest lists the file and content hash for each unit.  Only units
+whose bookings changed are rewritten.  Unit files are named by their content hash, so writing them never touches the
+state of a run in progress; the manifest is then swapped in with an ETag conditional put, so two concurrent runs can't
+silently overwrite each other.
+
+The manifest carries a schema version.  The legacy rentals.json is treated as version 1 and migrated on first load.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import re
+import aws_clients
+from config import CLEANING_BUCKET_NAME
+
+STATE_SCHEMA_VERSION = 2
+STATE_PREFIX = 'rentals/'
+MANIFEST_KEY = STATE_PREFIX + 'manifest.json'
+LEGACY_STATE_KEY = 'rentals.json'
+
+# Attempts to load the state when another run keeps replacing unit files while it loads
+STATE_LOAD_ATTEMPTS = 3
+
+
+def unit_hash(bookings):
+    """
+    Hashes one unit's bookings, to tell if it needs rewriting
+    :param bookings: dict of booking ID to booking details
+    :return: hex digest string
+    """
+    return hashlib.sha256(json.dumps(bookings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def unit_key(unit, content_hash):
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', unit).strip('-').lower() or "unit"
+    return f"{STATE_PREFIX}{slug}-{content_hash[:16]}.jsonl.gz"
+
+
+def encode_unit(bookings):
+    lines = [json.dumps(dict(details, id=booking_id), separators=(',', ':')) for booking_id, details in bookings.items()]
+    return gzip.compress("\n".join(lines).encode('utf-8'))
+
+
+def decode_unit(body):
+    bookings = {}
+    for line in gzip.decompress(body).decode('utf-8').splitlines():
+        if line:
+            details = json.loads(line)
+            bookings[details.pop('id')] = details
+    return bookings
+
+
+def migrate_from_v1(legacy_state):
+    """
+    The legacy rentals.json already has the unit -> booking ID -> details layout, so it loads as is
+    """
+    return legacy_state
+
+
+# Migrations to bring older state up to the current schema, keyed by the version they migrate from
+MIGRATIONS = {
+    1: migrate_from_v1
+}
+
+
+class BookingStateStore:
+
+    def __init__(self):
+        self.manifest = None
+        self.manifest_etag = None
+
+
+    def load(self, units=None):
+        """
+        Loads the booking state saved by the last run
+        :param units: Only load the bookings for these units (the legacy rentals.json is always loaded whole)
+        :return: dict of unit -> booking ID -> details, in the same layout rentals.json used
+        """
+        s3 = aws_clients.get_client('s3')
+        for attempt in range(1, STATE_LOAD_ATTEMPTS + 1):
+            try:
+                response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=MANIFEST_KEY)
+            except s3.exceptions.NoSuchKey:
+                return self._load_legacy()
+
+            self.manifest = json.loads(response['Body'].read().decode('utf-8'))
+            self.manifest_etag = response['ETag']
+
+            # Another run saving the state deletes the unit files its new manifest replaced, so a unit file can go
+            # missing part way through.  The manifest it saved points at the new files, so load that instead.
+            try:
+                state = self._load_units(units)
+                break
+            except s3.exceptions.NoSuchKey:
+                if attempt == STATE_LOAD_ATTEMPTS:
+                    raise
+                logging.info("Booking state was saved by another run while loading, reloading it")
+
+        state = self._migrate(state, self.manifest['schema_version'])
+        logging.info(f"Loaded booking state for {len(state)} units (schema version {self.manifest['schema_version']})")
+        return state
+
+
+    def _load_units(self, units=None):
+        """
+        Loads the unit files listed in the manifest
+        :param units: Only load these units
+        :return: dict of unit -> booking ID -> details
+        """
+        s3 = aws_clients.get_client('s3')
+        state = {}
+        for unit, entry in self.manifest['units'].items():
+            if units is not None and unit not in units:
+                continue
+            body = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=entry['key'])['Body'].read()
+            state[unit] = decode_unit(body)
+        return state
+
+
+    def _load_legacy(self):
+        """
+        Loads the old single file rentals.json, from before the state was split per unit
+        :return: dict of unit -> booking ID -> details
+        """
+        s3 = aws_clients.get_client('s3')
+        try:
+            response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=LEGACY_STATE_KEY)
+        except s3.exceptions.NoSuchKey:
+            logging.info("No saved booking state found, starting fresh")
+            return {}
+
+        logging.info(f"Migrating booking state from {LEGACY_STATE_KEY}")
+        return self._migrate(json.loads(response['Body'].read().decode('utf-8')), 1)
+
+
+    def _migrate(self, state, version):
+        while version < STATE_SCHEMA_VERSION:
+            state = MIGRATIONS[version](state)
+            version += 1
+        return state
+
+
+    def save(self, state, partial=False):
+        """
+        Saves the booking state, rewriting only the units that changed
+        :param state: dict of unit -> booking ID -> details
+        :param partial: Set to True if state only holds some of the units (see load), to keep the rest as they are
+        :return: True if saved, False if another run changed the state since we loaded it
+        """
+        s3 = aws_clients.get_client('s3')
+        old_units = self.manifest['units'] if self.manifest else {}
+        new_units = dict(old_units) if partial else {}
+        written = []
+
+        for unit, bookings in state.items():
+            content_hash = unit_hash(bookings)
+            if unit in old_units and old_units[unit]['hash'] == content_hash:
+                new_units[unit] = old_units[unit]
+                continue
+
+            key = unit_key(unit, content_hash)
+            s3.put_object(Body=encode_unit(bookings), Bucket=CLEANING_BUCKET_NAME, Key=key)
+            new_units[unit] = {
+                "key": key,
+                "hash": content_hash
+            }
+            written.append(key)
+
+        manifest = {
+            "schema_version": STATE_SCHEMA_VERSION,
+            "units": new_units
+        }
+
+        # Only replace the manifest if it is still the one we loaded
+        conditions = {"IfMatch": self.manifest_etag} if self.manifest_etag else {"IfNoneMatch": "*"}
+        try:
+            response = s3.put_object(Body=json.dumps(manifest), Bucket=CLEANING_BUCKET_NAME, Key=MANIFEST_KEY,
+                                     **conditions)
+        except s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ["PreconditionFailed", "ConditionalRequestConflict"]:
+                logging.error("ERROR! Booking state was changed by another run, not saving this run's state")
+                self._delete_unused(written)
+                return False
+            raise
+
+        # Clean up unit files the new manifest no longer points at
+        live_keys = {entry['key'] for entry in new_units.values()}
+        for entry in old_units.values():
+            if entry['key'] not in live_keys:
+                s3.delete_object(Bucket=CLEANING_BUCKET_NAME, Key=entry['key'])
+
+        self.manifest = manifest
+        self.manifest_etag = response['ETag']
+        logging.info(f"Saved booking state, rewrote {len(written)} of {len(new_units)} units")
+        return True
+
+
+    def _delete_unused(self, keys):
+        """
+        Deletes unit files this run wrote for a manifest that was never saved.  Unit files are named by their content,
+        so any the current manifest points at (written by another run with the same bookings) are kept.
+        :param keys: Unit file keys written by this run
+        """
+        s3 = aws_clients.get_client('s3')
+        try:
+            response = s3.get_object(Bucket=CLEANING_BUCKET_NAME, Key=MANIFEST_KEY)
+            live_keys = {entry['key'] for entry in json.loads(response['Body'].read().decode('utf-8'))['units'].values()}
+        except s3.exceptions.NoSuchKey:
+            live_keys = set()
+
+        for key in keys:
+            if key not in live_keys:
+                s3.delete_object(Bucket=CLEANING_BUCKET_NAME, Key=key)
@@ -0,0 +1,91 @@
+"""
+Per-unit index of stays for the cleaning report.  A unit's stays are sorted by check-in, with the dates parsed (so
+comparisons are year aware), and the index answers the schedule questions the report asks with a binary search:
+
+- Turnovers: does another stay check out on the day this one checks in?
+- Overlaps: which stays overlap a date range?  Two stays that overlap at the same unit are a double booking.
+
+A check-out on the same day as the next check-in is a turnover, not an overlap.
+"""
+
+import bisect
+from collections import namedtuple
+from datetime import date
+
+# One stay: its parsed check-in and check-out dates, and its booking ID
+Stay = namedtuple("Stay", ["check_in", "check_out", "booking_id"])
+
+
+class StayIndex:
+    """
+    A unit's stays, sorted by check-in
+    """
+    __slots__ = ("stays", "_check_ins", "_check_outs", "_reach")
+
+    def __init__(self, stays):
+        """
+        :param stays: Iterable of Stay
+        """
+        self.stays = tuple(sorted(stays, key=lambda stay: (stay.check_in, stay.check_out)))
+        self._check_ins = [stay.check_in for stay in self.stays]
+        self._check_outs = sorted(stay.check_out for stay in self.stays)
+
+        # The latest check-out of the stays up to each position, which never decreases, so the first stay that can reach
+        # past a date can be found with a binary search even when stays overlap
+        self._reach = []
+        for stay in self.stays:
+            self._reach.append(max(self._reach[-1], stay.check_out) if self._reach else stay.check_out)
+
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        Builds the index from a unit's entries in a BookingDiff, leaving out cancelled bookings
+        :param entries: Iterable of DiffEntry
+        :return: StayIndex
+        """
+        return cls(Stay(date.fromisoformat(details['check_in_date']), date.fromisoformat(details['check_out_date']),
+                        booking_id)
+                   for booking_id, details, state in entries if state != "Cancelled")
+
+
+    def check_outs_on(self, day):
+        """
+        :param day: date
+        :return: Number of stays that check out on the day
+        """
+        return bisect.bisect_right(self._check_outs, day) - bisect.bisect_left(self._check_outs, day)
+
+
+    def is_turnover(self, stay):
+        """
+        :param stay: Stay in the index
+        :return: True if another stay checks out on the day this one checks in
+        """
+        return self.check_outs_on(stay.check_in) > 0
+
+
+    def overlapping(self, check_in, check_out):
+        """
+        :param check_in: date the range starts
+        :param check_out: date the range ends (a stay checking in on this day does not overlap)
+        :return: list of the stays that overlap the range
+        """
+        end = bisect.bisect_left(self._check_ins, check_out)
+        start = bisect.bisect_right(self._reach, check_in, 0, end)
+        return [stay for stay in self.stays[start:end] if stay.check_out > check_in]
+
+
+    def double_booked(self, stay):
+        """
+        :param stay: Stay in the index
+        :return: list of the other stays that overlap it
+        """
+        return [other for other in self.overlapping(stay.check_in, stay.check_out) if other is not stay]
+
+
+    def double_bookings(self):
+        """
+        :return: set of the booking IDs that overlap another stay
+        """
+        return {stay.booking_id for stay in self.stays if self.double_booked(stay)}
@@ -0,0 +1,222 @@
+"""
+Lambda entry point for Lodgify booking webhooks (new, changed and cancelled bookings), behind a lambda function URL.
+Rather than re-scanning the whole window like the scheduled runs, each event only handles the booking that changed:
+
+- If the stay is inside the lock automation's window, it runs the same door code steps as guest_handler.py, so a last
+  minute booking gets its code within seconds.
+- It updates the cleaning state for the booking's unit only, and sends the cleaning email and Slack message for that
+  unit if the booking's entry changed.
+
+Only the booking ID is taken from the webhook, the booking itself is always fetched from Lodgify.  Requests must carry
+an ms-signature header (an HMAC-SHA256 of the body) matching the LODGIFY_WEBHOOK_SECRET environment variable, and are
+all rejected if it isn't set, as the function URL itself is public.  The scheduled runs stay in place as a reconciliation sweep, for any events that were missed, and for
+bookings that move between units.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+import retry
+from metrics import METRICS
+from http_cache import HTTP_CACHE
+from lock import Lock
+from lodgify import Lodgify
+from door_code_outbox import DoorCodeOutbox
+from codes_ledger import CodesLedger
+from state_store import BookingStateStore
+from booking_diff import diff_bookings
+from guest_handler import process_booking, already_issued_outcome, settle_outcome, report_errors, send_slack_output
+from cleaning_automation import format_email_output, format_slack_output, send_email, send_cleaning_slack_output
+from config import DAYS_IN_FUTURE_TO_CHECK, DAYS_IN_FUTURE_FOR_CLEANINGS
+
+##############
+# Configuration
+##############
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:  %(message)s', level=logging.INFO)
+
+# Statuses that hold the dates, the same as the availability calendar shows
+ACTIVE_STATUSES = ["Booked", "Tentative"]
+
+
+def verify_signature(body, signature):
+    """
+    Checks the webhook's ms-signature header against the configured secret
+    :param body: Raw request body (bytes)
+    :param signature: The ms-signature header, with or without a "sha256=" prefix
+    :return: True if it matches, False if it doesn't, or if no secret is configured
+    """
+    secret = os.getenv("LODGIFY_WEBHOOK_SECRET")
+    if not secret:
+        logging.error("ERROR! LODGIFY_WEBHOOK_SECRET is not set, rejecting the webhook")
+        return False
+    if not signature:
+        return False
+
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.split("=", 1)[-1].lower())
+
+
+def booking_ids_from_payload(payload):
+    """
+    Gets the booking IDs from a webhook payload, which may hold a single event or a list of them
+    :param payload: Parsed webhook body
+    :return: List of booking IDs, without duplicates
+    """
+    events = payload if isinstance(payload, list) else [payload]
+    booking_ids = []
+    for event in events:
+        if not isinstance(event, dict):
+            continue
+        booking_id = (event.get('booking') or {}).get('id') or event.get('booking_id')
+        if booking_id and booking_id not in booking_ids:
+            booking_ids.append(booking_id)
+    return booking_ids
+
+
+def is_active(booking):
+    """
+    Checks if a booking holds its dates.  Lodgify can keep the status of a deleted booking as "Booked", so deleted
+    bookings are never active.
+    :param booking: BookingRecord, from Lodgify.get_booking_details
+    :return: True or False
+    """
+    return booking.status in ACTIVE_STATUSES and not booking.is_deleted
+
+
+def in_window(booking, days):
+    """
+    Checks if a stay overlaps the window from today to the given number of days from now
+    :param booking: BookingRecord, from Lodgify.get_booking_details
+    :param days: Days in the future the window ends
+    :return: True or False
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    end = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
+    return booking.arrival <= end and booking.departure >= today
+
+
+def handle_door_code(booking_id, booking, Lodge):
+    """
+    Runs the door code steps for the booking, if its stay is inside the lock automation's window
+    :return: dict of codes_sent, codes_skipped and errors lines
+    """
+    results = {
+        "codes_sent": [],
+        "codes_skipped": [],
+        "errors": []
+    }
+    if not is_active(booking) or not in_window(booking, DAYS_IN_FUTURE_TO_CHECK):
+        return results
+
+    ledger = CodesLedger()
+    outbox = DoorCodeOutbox(ledger=ledger)
+    if ledger.issued(booking_id):
+        outcome = settle_outcome(already_issued_outcome(ledger.issued(booking_id)), None)
+    else:
+        outcome = process_booking(booking_id, booking, Lodge, Lock(), outbox, ledger.pending(booking_id))
+        outcome = settle_outcome(outcome, outbox.flush().get(booking_id))
+
+    if outcome['ledger_entry']:
+        ledger.record(booking_id=booking_id, **outcome['ledger_entry'])
+        ledger.save()
+
+    for key in results:
+        results[key].extend(outcome[key])
+    return results
+
+
+def handle_cleaning_update(booking_id, booking):
+    """
+    Updates the booking's entry in its unit's cleaning state, and sends the cleaning email and Slack message for the
+    unit if the entry changed
+    :return: True if the unit's bookings changed, False otherwise
+    """
+    unit = booking.unit
+    store = BookingStateStore()
+    state = store.load(units=[unit])
+    previous_unit = state.get(unit, {})
+
+    current_unit = dict(previous_unit)
+    current_unit.pop(str(booking_id), None)
+    if is_active(booking) and in_window(booking, DAYS_IN_FUTURE_FOR_CLEANINGS):
+        current_unit[str(booking_id)] = booking.state_entry()
+
+    booking_diff = diff_bookings(previous={unit: previous_unit}, current={unit: current_unit},
+                                 today=datetime.now().strftime("%Y-%m-%d"))
+    if not booking_diff.has_changes:
+        logging.info(f"No cleaning changes for {unit}")
+        return False
+
+    send_email(message=format_email_output(booking_diff))
+    send_cleaning_slack_output(format_slack_output(booking_diff), True)
+
+    state[unit] = booking_diff.to_state()[unit]
+    store.save(state, partial=True)
+    return True
+
+
+def handle_booking_event(booking_id, Lodge):
+    """
+    Handles a webhook event for one booking
+    :param booking_id: The booking that changed
+    :param Lodge: Lodgify client
+    :return: dict summarizing what was done for the booking
+    """
+    booking = Lodge.get_booking_details(booking_id=booking_id, use_cache=False)
+    if isinstance(booking, str):
+        report_errors([booking])
+        return {"booking_id": booking_id, "error": booking}
+
+    # Skip rentals that are not in our config
+    if booking.unit is None:
+        logging.info(f"Booking {booking_id} is not for a tracked property, skipping")
+        return {"booking_id": booking_id, "skipped": True}
+
+    logging.info("Booking {} for {}: {}, {} - {}".format(booking_id, booking.unit, booking.status, booking.arrival,
+                                                       booking.departure))
+
+    results = handle_door_code(booking_id, booking, Lodge)
+    if results['errors']:
+        report_errors(results['errors'])
+    if results['codes_sent'] or results['errors']:
+        send_slack_output(results, results['errors'])
+
+    cleaning_changed = handle_cleaning_update(booking_id, booking)
+
+    return {
+        "booking_id": booking_id,
+        "codes_sent": len(results['codes_sent']),
+        "errors": len(results['errors']),
+        "cleaning_changed": cleaning_changed
+    }
+
+
+def lambda_handler(event, context):
+    retry.RETRY_BUDGET.reset()
+    METRICS.reset()
+
+    body = event.get('body') or ""
+    body = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+
+    if not verify_signature(body, headers.get('ms-signature')):
+        logging.error("ERROR! Webhook signature did not match, ignoring the request")
+        return {"statusCode": 401, "body": json.dumps({"error": "bad signature"})}
+
+    try:
+        booking_ids = booking_ids_from_payload(json.loads(body))
+    except ValueError:
+        return {"statusCode": 400, "body": json.dumps({"error": "body is not JSON"})}
+
+    Lodge = Lodgify()
+    handled = [handle_booking_event(booking_id, Lodge) for booking_id in booking_ids]
+
+    HTTP_CACHE.log_stats()
+    METRICS.emit_emf(run_name="Webhook")
+    return {"statusCode": 200, "body": json.dumps({"bookings": handled})}
@@ -0,0 +1,73 @@
+"""
+Queues for the fan-out mode (see fanout_handler.py).  SqsQueue sends work messages to the SQS queue the worker lambdas
+are triggered from.  LocalQueue is an in-process stand-in with the same send method, which hands its messages straight
+to a worker handler, in the same event format SQS uses, so the whole fan-out can be run locally.
+"""
+
+import json
+import logging
+from collections import deque
+import aws_clients
+
+# Most messages SQS takes in one send_message_batch call
+SQS_BATCH_SIZE = 10
+
+
+class SqsQueue:
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+
+
+    def send(self, messages):
+        """
+        Sends the messages to the queue, in batches
+        :param messages: List of JSON serializable dicts
+        :return: List of the messages that could not be sent
+        """
+        sqs = aws_clients.get_client('sqs')
+        failed = []
+        for start in range(0, len(messages), SQS_BATCH_SIZE):
+            batch = messages[start:start + SQS_BATCH_SIZE]
+            response = sqs.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(i), "MessageBody": json.dumps(message)} for i, message in enumerate(batch)]
+            )
+            for failure in response.get('Failed', []):
+                logging.error(f"ERROR! Could not queue message: {failure.get('Message')}")
+                failed.append(batch[int(failure['Id'])])
+
+        return failed
+
+
+class LocalQueue:
+    """
+    In-process stand-in for SqsQueue, for running and testing the fan-out without AWS
+    """
+
+    def __init__(self):
+        self.messages = deque()
+        self.sent = 0
+
+
+    def send(self, messages):
+        """
+        Holds the messages until the queue is drained
+        :param messages: List of JSON serializable dicts
+        :return: List of the messages that could not be sent, which is always empty
+        """
+        for message in messages:
+            self.sent += 1
+            self.messages.append({"messageId": str(self.sent), "body": json.dumps(message),
+                                  "attributes": {"ApproximateReceiveCount": "1"}})
+        return []
+
+
+    def drain(self, handler):
+        """
+        Delivers each message to the handler, one per event, until the queue is empty.  Messages the handler sends
+        while it runs are delivered too.
+        :param handler: Lambda handler to deliver to, ex: fanout_handler.worker_handler
+        """
+        while self.messages:
+            handler({"Records": [self.messages.popleft()]}, None)
@@ -16,6 +16,42 @@ resource "aws_s3_bucket" "this" {
     }
   }
 
+  # Outcomes saved by fan-out runs are only needed until the run is aggregated
+  lifecycle_rule {
+    id      = "expire-fanout-runs"
+    enabled = true
+    prefix  = "fanout/"
+
+    expiration {
+      days = 7
+    }
+
+    noncurrent_version_expiration {
+      days = 1
+    }
+  }
+
+}
+
+###############
+# Fan-out Queue
+###############
+# Queue of per-unit work for the fan-out worker lambda, only created if fan-out is enabled
+resource "aws_sqs_queue" "fanout_dlq" {
+  count                     = var.fanout_enabled ? 1 : 0
+  name                       = "${var.lambda_function_name}-fanout-dlq"
+  message_retention_seconds  = 1209600
+  visibility_timeout_seconds = var.fanout_worker_execution_timeout * 6
+}
+
+resource "aws_sqs_queue" "fanout" {
+  count                      = var.fanout_enabled ? 1 : 0
+  name                       = "${var.lambda_function_name}-fanout"
+  visibility_timeout_seconds = var.fanout_worker_execution_timeout * 6
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.fanout_dlq[0].arn
+    maxReceiveCount     = 3
+  })
 }
 
 
@@ -61,7 +97,29 @@ resource "aws_iam_role_policy" "this" {
             ],
             "Resource": [
               "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}",
-              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}:log-stream:*"
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}:log-stream:*",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.cleaning_lambda_function_name}",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.cleaning_lambda_function_name}:log-stream:*",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}-worker",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}-worker:log-stream:*",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}-dead-letter",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}-dead-letter:log-stream:*",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}-webhook",
+              "arn:aws:logs:*:*:log-group:/aws/lambda/${var.lambda_function_name}-webhook:log-stream:*"
+            ]
+        },
+        {
+            "Sid": "UseFanoutQueue",
+            "Effect": "Allow",
+            "Action": [
+                "sqs:SendMessage",
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:GetQueueAttributes"
+            ],
+            "Resource": [
+                "arn:aws:sqs:*:*:${var.lambda_function_name}-fanout",
+                "arn:aws:sqs:*:*:${var.lambda_function_name}-fanout-dlq"
             ]
         },
         {
@@ -118,13 +176,13 @@ data "archive_file" "this" {
   output_path = "../zip_files/lambda.zip"
 }
 
-# Create lambda function
+# Create lambda function for the lock automation
 resource "aws_lambda_function" "this" {
   filename         = "../zip_files/lambda.zip"
   function_name    = var.lambda_function_name
   layers           = [aws_lambda_layer_version.lambda_layer.arn]
   role             = aws_iam_role.this.arn
-  handler          = "guest_handler.lambda_handler"
+  handler          = var.fanout_enabled ? "fanout_handler.coordinator_handler" : "guest_handler.lambda_handler"
   runtime          = "python3.9"
   memory_size      = var.lambda_memory_size
   timeout          = var.lambda_execution_timeout
@@ -135,12 +193,147 @@ resource "aws_lambda_function" "this" {
       LOCK_CLIENT = var.lock_client,
       LOCK_SECRET = var.lock_secret,
       LOCK_CODE = var.lock_code,
+      SLACK_WEBHOOK = var.slack_webhook,
+      FANOUT_QUEUE_URL = var.fanout_enabled ? aws_sqs_queue.fanout[0].url : ""
+    }
+
+  }
+}
+
+# Create lambda function for the fan-out workers, which process the door codes for one unit per message
+resource "aws_lambda_function" "worker" {
+  count            = var.fanout_enabled ? 1 : 0
+  filename         = "../zip_files/lambda.zip"
+  function_name    = "${var.lambda_function_name}-worker"
+  layers           = [aws_lambda_layer_version.lambda_layer.arn]
+  role             = aws_iam_role.this.arn
+  handler          = "fanout_handler.worker_handler"
+  runtime          = "python3.9"
+  memory_size      = var.fanout_worker_memory_size
+  timeout          = var.fanout_worker_execution_timeout
+  source_code_hash = data.archive_file.this.output_base64sha256
+  environment {
+    variables = {
+      LODGIFY_API_KEY = var.lodgify_api_key,
+      LOCK_CLIENT = var.lock_client,
+      LOCK_SECRET = var.lock_secret,
+      LOCK_CODE = var.lock_code,
+      SLACK_WEBHOOK = var.slack_webhook
+    }
+
+  }
+}
+
+# Trigger the workers from the fan-out queue
+resource "aws_lambda_event_source_mapping" "worker" {
+  count            = var.fanout_enabled ? 1 : 0
+  event_source_arn = aws_sqs_queue.fanout[0].arn
+  function_name    = aws_lambda_function.worker[0].arn
+  batch_size       = var.fanout_worker_batch_size
+  scaling_config {
+    maximum_concurrency = var.fanout_worker_max_concurrency
+  }
+}
+
+# Create log group for the workers, with our set retention period
+resource "aws_cloudwatch_log_group" "worker" {
+  count             = var.fanout_enabled ? 1 : 0
+  name              = "/aws/lambda/${var.lambda_function_name}-worker"
+  retention_in_days = var.cloudwatch_log_retention_in_days
+}
+
+# Create lambda function for work messages that end up in the dead letter queue, which reports their bookings as
+# errors so the run still sends its results
+resource "aws_lambda_function" "dead_letter" {
+  count            = var.fanout_enabled ? 1 : 0
+  filename         = "../zip_files/lambda.zip"
+  function_name    = "${var.lambda_function_name}-dead-letter"
+  layers           = [aws_lambda_layer_version.lambda_layer.arn]
+  role             = aws_iam_role.this.arn
+  handler          = "fanout_handler.dead_letter_handler"
+  runtime          = "python3.9"
+  memory_size      = var.fanout_worker_memory_size
+  timeout          = var.fanout_worker_execution_timeout
+  source_code_hash = data.archive_file.this.output_base64sha256
+  environment {
+    variables = {
       SLACK_WEBHOOK = var.slack_webhook
     }
 
   }
 }
 
+# Trigger the dead letter handler from the dead letter queue
+resource "aws_lambda_event_source_mapping" "dead_letter" {
+  count            = var.fanout_enabled ? 1 : 0
+  event_source_arn = aws_sqs_queue.fanout_dlq[0].arn
+  function_name    = aws_lambda_function.dead_letter[0].arn
+  batch_size       = 1
+}
+
+# Create log group for the dead letter handler, with our set retention period
+resource "aws_cloudwatch_log_group" "dead_letter" {
+  count             = var.fanout_enabled ? 1 : 0
+  name              = "/aws/lambda/${var.lambda_function_name}-dead-letter"
+  retention_in_days = var.cloudwatch_log_retention_in_days
+}
+
+# Create lambda function for the cleaning report, which runs separately from the lock automation
+resource "aws_lambda_function" "cleaning" {
+  filename         = "../zip_files/lambda.zip"
+  function_name    = var.cleaning_lambda_function_name
+  layers           = [aws_lambda_layer_version.lambda_layer.arn]
+  role             = aws_iam_role.this.arn
+  handler          = "cleaning_handler.lambda_handler"
+  runtime          = "python3.9"
+  memory_size      = var.cleaning_lambda_memory_size
+  timeout          = var.cleaning_lambda_execution_timeout
+  source_code_hash = data.archive_file.this.output_base64sha256
+  environment {
+    variables = {
+      LODGIFY_API_KEY = var.lodgify_api_key,
+      SLACK_WEBHOOK = var.slack_webhook
+    }
+
+  }
+}
+
+# Create lambda function for Lodgify booking webhooks, which handles just the booking that changed
+resource "aws_lambda_function" "webhook" {
+  filename         = "../zip_files/lambda.zip"
+  function_name    = "${var.lambda_function_name}-webhook"
+  layers           = [aws_lambda_layer_version.lambda_layer.arn]
+  role             = aws_iam_role.this.arn
+  handler          = "webhook_handler.lambda_handler"
+  runtime          = "python3.9"
+  memory_size      = var.webhook_memory_size
+  timeout          = var.webhook_execution_timeout
+  source_code_hash = data.archive_file.this.output_base64sha256
+  environment {
+    variables = {
+      LODGIFY_API_KEY = var.lodgify_api_key,
+      LOCK_CLIENT = var.lock_client,
+      LOCK_SECRET = var.lock_secret,
+      LOCK_CODE = var.lock_code,
+      SLACK_WEBHOOK = var.slack_webhook,
+      LODGIFY_WEBHOOK_SECRET = var.lodgify_webhook_secret
+    }
+
+  }
+}
+
+# Public URL to register with Lodgify.  Lodgify can't sign requests for IAM, the handler checks its signature instead.
+resource "aws_lambda_function_url" "webhook" {
+  function_name      = aws_lambda_function.webhook.function_name
+  authorization_type = "NONE"
+}
+
+# Create log group for the webhook function, with our set retention period
+resource "aws_cloudwatch_log_group" "webhook" {
+  name              = "/aws/lambda/${var.lambda_function_name}-webhook"
+  retention_in_days = var.cloudwatch_log_retention_in_days
+}
+
 ################
 # Cloudwatch Assets
 ################
@@ -174,3 +367,33 @@ resource "aws_cloudwatch_log_group" "this" {
   name              = "/aws/lambda/${var.lambda_function_name}"
   retention_in_days = var.cloudwatch_log_retention_in_days
 }
+
+# Cloudwatch rule to run the cleaning report, on its own schedule
+resource "aws_cloudwatch_event_rule" "cleaning" {
+  name                = var.cleaning_lambda_function_name
+  description         = "Run cleaning report on set schedule"
+  schedule_expression = var.cleaning_execution_rule_expression
+  is_enabled          = true
+}
+
+# Create cloudwatch trigger
+resource "aws_cloudwatch_event_target" "cleaning" {
+  rule      = aws_cloudwatch_event_rule.cleaning.name
+  target_id = var.cleaning_lambda_function_name
+  arn       = aws_lambda_function.cleaning.arn
+}
+
+# Allow cloudwatch to invoke the cleaning report
+resource "aws_lambda_permission" "cleaning_cloudwatch" {
+  statement_id  = "AllowExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.cleaning.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cleaning.arn
+}
+
+# Create log group for the cleaning report, with our set retention period
+resource "aws_cloudwatch_log_group" "cleaning" {
+  name              = "/aws/lambda/${var.cleaning_lambda_function_name}"
+  retention_in_days = var.cloudwatch_log_retention_in_days
+}
@@ -0,0 +1,4 @@
+output "webhook_url" {
+  description = "URL to subscribe to Lodgify's booking webhooks"
+  value       = aws_lambda_function_url.webhook.function_url
+}
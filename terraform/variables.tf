@@ -1,25 +1,91 @@
 variable "lambda_execution_rule_expression" {
   type        = string
-  description = "The rate expression to run the lambda, ex: 'rate(1 days)'"
+  description = "The rate expression to run the lock automation lambda, ex: 'rate(1 hour)'"
   default = "cron(30 13 ? * * *)"
 }
 
+variable "cleaning_execution_rule_expression" {
+  type        = string
+  description = "The rate expression to run the cleaning report lambda, ex: 'rate(1 days)'"
+  default = "cron(45 13 ? * * *)"
+}
+
 variable "lambda_function_name" {
   type        = string
   description = "Name of the lambda function"
   default = "LodgifyLockAutomation"
 }
 
+variable "cleaning_lambda_function_name" {
+  type        = string
+  description = "Name of the cleaning report lambda function"
+  default = "LodgifyCleaningReport"
+}
+
 variable "lambda_memory_size" {
   type        = number
   default     = 2048
-  description = "Memory size in MB for lambdas in this project"
+  description = "Memory size in MB for the lock automation lambda"
 }
 
 variable "lambda_execution_timeout" {
   type        = number
   default     = 600
-  description = "Timeout in seconds for the lambda functions"
+  description = "Timeout in seconds for the lock automation lambda"
+}
+
+variable "cleaning_lambda_memory_size" {
+  type        = number
+  default     = 1024
+  description = "Memory size in MB for the cleaning report lambda"
+}
+
+variable "cleaning_lambda_execution_timeout" {
+  type        = number
+  default     = 900
+  description = "Timeout in seconds for the cleaning report lambda"
+}
+
+variable "fanout_enabled" {
+  type        = bool
+  default     = false
+  description = "Spread the lock automation over worker lambdas fed by an SQS queue, one message per unit"
+}
+
+variable "fanout_worker_memory_size" {
+  type        = number
+  default     = 512
+  description = "Memory size in MB for the fan-out worker lambda"
+}
+
+variable "fanout_worker_execution_timeout" {
+  type        = number
+  default     = 300
+  description = "Timeout in seconds for the fan-out worker lambda"
+}
+
+variable "fanout_worker_batch_size" {
+  type        = number
+  default     = 1
+  description = "Units each fan-out worker invocation processes"
+}
+
+variable "fanout_worker_max_concurrency" {
+  type        = number
+  default     = 5
+  description = "Most fan-out workers to run at once, keeps the Lodgify and RemoteLock rate limits in reach"
+}
+
+variable "webhook_memory_size" {
+  type        = number
+  default     = 512
+  description = "Memory size in MB for the Lodgify webhook lambda"
+}
+
+variable "webhook_execution_timeout" {
+  type        = number
+  default     = 60
+  description = "Timeout in seconds for the Lodgify webhook lambda"
 }
 
 variable "cloudwatch_log_retention_in_days" {
@@ -51,4 +117,15 @@ variable "slack_webhook" {
 
 variable "bucket" {
   type = string
-}
\ No newline at end of file
+}
+
+variable "lodgify_webhook_secret" {
+  type        = string
+  sensitive   = true
+  description = "Secret Lodgify signs webhooks with (ms-signature header).  Requests without a matching signature are rejected."
+
+  validation {
+    condition     = length(var.lodgify_webhook_secret) > 0
+    error_message = "The webhook URL is public, so lodgify_webhook_secret must be set."
+  }
+}
@@ -0,0 +1,17 @@
+"""
+Puts lambda_code on the path, with config_template.py standing in for the deployment's config.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+LAMBDA_CODE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda_code")
+
+CONFIG_DIR = tempfile.mkdtemp()
+shutil.copy(os.path.join(LAMBDA_CODE, "config_template.py"), os.path.join(CONFIG_DIR, "config.py"))
+sys.path[:0] = [CONFIG_DIR, LAMBDA_CODE]
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
@@ -0,0 +1,88 @@
+"""
+The codes ledger, the booking state manifest and the fan-out claims are saved with S3 conditional puts (IfMatch and
+IfNoneMatch), which botocore only accepts from 1.35.68 on.  These run the saves against a real S3 client with a
+botocore Stubber, so the parameters are validated against the installed botocore's S3 model, as they would be on the
+Lambda runtime.
+"""
+
+import io
+import json
+import boto3
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import ANY, Stubber
+import aws_clients
+from config import CLEANING_BUCKET_NAME
+
+
+@pytest.fixture
+def s3():
+    client = boto3.client('s3', region_name='us-east-1')
+    aws_clients.set_client('s3', client)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+    aws_clients.reset()
+
+
+def body(data):
+    raw = json.dumps(data).encode('utf-8')
+    return {"Body": StreamingBody(io.BytesIO(raw), len(raw)), "ETag": '"loaded"'}
+
+
+def test_ledger_save_new_ledger(s3):
+    from codes_ledger import CodesLedger, LEDGER_KEY
+    s3.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+    ledger = CodesLedger()
+
+    ledger.record(1, "Unit", "Guest", "2099-01-01", "2099-01-03", pin="1234", lock_guest_id="g1")
+    s3.add_response('put_object', {"ETag": '"saved"'},
+                    {"Body": json.dumps(ledger.entries), "Bucket": CLEANING_BUCKET_NAME, "Key": LEDGER_KEY,
+                     "IfNoneMatch": "*"})
+    assert ledger.save()
+    assert ledger.etag == '"saved"'
+
+
+def test_ledger_save_merges_on_conflict(s3):
+    from codes_ledger import CodesLedger
+    theirs = {"2": {"unit": "Unit", "guest_name": "Other", "arrival": "2099-01-01", "departure": "2099-01-03"}}
+    s3.add_response('get_object', body({}))
+    ledger = CodesLedger()
+
+    ledger.record(1, "Unit", "Guest", "2099-01-01", "2099-01-03")
+    s3.add_client_error('put_object', service_error_code='PreconditionFailed', http_status_code=412,
+                        expected_params={"Body": json.dumps(ledger.entries), "Bucket": CLEANING_BUCKET_NAME,
+                                         "Key": "codes_issued.json", "IfMatch": '"loaded"'})
+    s3.add_response('get_object', body(theirs))
+    s3.add_response('put_object', {"ETag": '"saved"'})
+    assert ledger.save()
+    assert sorted(ledger.entries) == ["1", "2"]
+
+
+def test_put_once(s3):
+    from fanout_handler import _put_once
+    params = {"Body": "claimed", "Bucket": CLEANING_BUCKET_NAME, "Key": "fanout/run/claims/1", "IfNoneMatch": "*"}
+    s3.add_response('put_object', {"ETag": '"claim"'}, params)
+    s3.add_client_error('put_object', service_error_code='PreconditionFailed', http_status_code=412,
+                        expected_params=params)
+
+    assert _put_once("fanout/run/claims/1", "claimed")
+    assert not _put_once("fanout/run/claims/1", "claimed")
+
+
+def test_state_save_cleans_up_when_rejected(s3):
+    from state_store import BookingStateStore, MANIFEST_KEY, unit_hash, unit_key
+    s3.add_response('get_object', body({"schema_version": 2, "units": {}}))
+    store = BookingStateStore()
+    store.load()
+
+    bookings = {"1": {"name": "Guest"}}
+    key = unit_key("Unit", unit_hash(bookings))
+    s3.add_response('put_object', {"ETag": '"unit"'})
+    s3.add_client_error('put_object', service_error_code='PreconditionFailed', http_status_code=412,
+                        expected_params={"Body": ANY, "Bucket": CLEANING_BUCKET_NAME, "Key": MANIFEST_KEY,
+                                         "IfMatch": '"loaded"'})
+    s3.add_response('get_object', body({"schema_version": 2, "units": {}}))
+    s3.add_response('delete_object', {}, {"Bucket": CLEANING_BUCKET_NAME, "Key": key})
+
+    assert not store.save({"Unit": bookings})